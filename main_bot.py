@@ -1,24 +1,39 @@
+import csv
+import gzip
+import contextvars
+import json
 import logging
+import multiprocessing
 import re
 import secrets
 import string
-from aiogram import Bot, Dispatcher, types
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
 import pymysql
+from pymysql.constants import SERVER_STATUS
 import asyncio
-from aiogram.types import InputFile
+from aiogram.types import FSInputFile, InputFile
 from aiogram import F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from aiogram.types import ReplyParameters
 from aiogram import Router
 from datetime import datetime, timedelta, date
 import pandas as pd
+import openpyxl
 from io import BytesIO
 import os
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -28,23 +43,1101 @@ DB_CONFIG = {
     'user': os.getenv('DB_USER'),
     'password': os.getenv('DB_PASSWORD'),
     'charset': 'utf8mb4',
+    'autocommit': True,
     'init_command': "SET NAMES utf8mb4 COLLATE utf8mb4_general_ci",
 }
 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', '30'))
+
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', str(DB_POOL_SIZE)))
+DB_EXECUTOR_QUEUE = int(os.getenv('DB_EXECUTOR_QUEUE', '100'))
+REPORT_EXECUTOR_WORKERS = int(os.getenv('REPORT_EXECUTOR_WORKERS', '2'))
+REPORT_EXECUTOR_QUEUE = int(os.getenv('REPORT_EXECUTOR_QUEUE', '4'))
+REPORT_PROCESS_WORKERS = int(os.getenv('REPORT_PROCESS_WORKERS', '2'))
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', '3600'))
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '8'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '5000'))
+REPORT_DAILY_AT = os.getenv('REPORT_DAILY_AT', '02:00')
+REPORT_MONTHLY_AT = os.getenv('REPORT_MONTHLY_AT', '03:00')
+
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', '300'))
+ROLE_CACHE_SIZE = int(os.getenv('ROLE_CACHE_SIZE', '10000'))
+
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', '25'))
+TG_PER_CHAT_INTERVAL = float(os.getenv('TG_PER_CHAT_INTERVAL', '1'))
+TG_PER_CHAT_BURST = float(os.getenv('TG_PER_CHAT_BURST', '3'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+CARD_EDIT_CONCURRENCY = int(os.getenv('CARD_EDIT_CONCURRENCY', '10'))
+DISPATCH_WAVE_SIZE = int(os.getenv('DISPATCH_WAVE_SIZE', '0'))
+DISPATCH_WAVE_INTERVAL = float(os.getenv('DISPATCH_WAVE_INTERVAL', '60'))
+PERFORMERS_REFRESH = float(os.getenv('PERFORMERS_REFRESH', '300'))
+DISPATCH_MAX_AGE_HOURS = int(os.getenv('DISPATCH_MAX_AGE_HOURS', '24'))
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'broadcast')
+ASSIGN_STRATEGY = os.getenv('ASSIGN_STRATEGY', 'least_loaded')
+ASSIGN_ACCEPT_TIMEOUT = float(os.getenv('ASSIGN_ACCEPT_TIMEOUT', '120'))
+
+PH_STATS_CACHE_TTL = float(os.getenv('PH_STATS_CACHE_TTL', '600'))
+PH_STATS_CACHE_SIZE = int(os.getenv('PH_STATS_CACHE_SIZE', '1000'))
+
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'mysql')
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+FSM_IDLE_TTL = float(os.getenv('FSM_IDLE_TTL', '21600'))
+FSM_EXPIRY_NOTICE = os.getenv('FSM_EXPIRY_NOTICE', '1') == '1'
+
+ALBUM_LATENCY = float(os.getenv('ALBUM_LATENCY', '0.6'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '100'))
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+
 API_TOKEN = os.getenv('API_TOKEN')
 
 ADMIN_ID_1=os.getenv('ADMIN_ID_1')
 ADMIN_ID_2=os.getenv('ADMIN_ID_2')
+ADMIN_CHAT_IDS = [int(admin_id) for admin_id in (ADMIN_ID_1, ADMIN_ID_2) if admin_id]
+
+
+class DBPoolTimeout(Exception):
+    pass
+
+
+class DBPool:
+    """Общий пул соединений pymysql: не больше maxsize выданных соединений, LIFO-переиспользование свободных."""
+
+    def __init__(self, config, maxsize=10, acquire_timeout=10.0, max_idle=300.0, ping_after=30.0):
+        self._config = config
+        self._maxsize = maxsize
+        self._acquire_timeout = acquire_timeout
+        self._max_idle = max_idle
+        self._ping_after = ping_after
+        self._slots = asyncio.Semaphore(maxsize)
+        self._idle = deque()  # (connection, released_at)
+        self._in_use = 0
+
+    async def acquire(self, timeout=None):
+        timeout = self._acquire_timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise DBPoolTimeout(f"Нет свободных соединений за {timeout} с (размер пула {self._maxsize})")
+        try:
+            connection = await self._checkout()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._in_use += 1
+        return connection
+
+    async def release(self, connection):
+        try:
+            if connection.open and connection.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                # Транзакция, начатая begin() и не завершённая из-за ошибки, не должна
+                # достаться следующему хендлеру. Чтение в autocommit транзакцию не открывает.
+                await asyncio.to_thread(connection.rollback)
+            if connection.open:
+                self._idle.append((connection, time.monotonic()))
+        except Exception as e:
+            logging.warning(f"Соединение выброшено из пула: {e}")
+            self._close(connection)
+        finally:
+            self._in_use -= 1
+            self._slots.release()
+            self._reap()
+
+    @asynccontextmanager
+    async def connection(self):
+        connection = await self.acquire()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    async def _checkout(self):
+        while self._idle:
+            connection, released_at = self._idle.pop()
+            idle_for = time.monotonic() - released_at
+            if idle_for > self._max_idle:
+                self._close(connection)
+                continue
+            if idle_for > self._ping_after:
+                try:
+                    await asyncio.to_thread(connection.ping, False)
+                except Exception:
+                    self._close(connection)
+                    continue
+            return connection
+        return await asyncio.to_thread(pymysql.connect, **self._config)
+
+    def _reap(self):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self._max_idle:
+            connection, _ = self._idle.popleft()
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {"size": self._maxsize, "in_use": self._in_use, "idle": len(self._idle)}
+
+    def close(self) -> None:
+        while self._idle:
+            connection, _ = self._idle.pop()
+            self._close(connection)
+
+
+db_pool = DBPool(
+    DB_CONFIG,
+    maxsize=DB_POOL_SIZE,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    ping_after=DB_POOL_PING_AFTER,
+)
+
+
+class BoundedExecutor:
+    """Пул потоков для блокирующей работы с ограниченной очередью и метриками ожидания."""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._started = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def run(self, func, *args):
+        ticket = {"submitted_at": time.monotonic(), "started": False}
+        with self._lock:
+            self._queued += 1
+        try:
+            async with self._slots:
+                future = self._executor.submit(self._call, ticket, func, args)
+                try:
+                    return await asyncio.wrap_future(future)
+                except asyncio.CancelledError:
+                    if not future.done():
+                        # Поток уже выполняет задачу: дожидаемся её, иначе соединение
+                        # вернётся в пул посреди запроса.
+                        await asyncio.wait([asyncio.wrap_future(future)])
+                    raise
+        finally:
+            with self._lock:
+                if not ticket["started"]:
+                    # Задачу отменили до старта в потоке.
+                    ticket["started"] = True
+                    self._queued -= 1
+
+    def _call(self, ticket, func, args):
+        waited = time.monotonic() - ticket["submitted_at"]
+        with self._lock:
+            if not ticket["started"]:
+                ticket["started"] = True
+                self._queued -= 1
+            self._running += 1
+            self._started += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self._workers,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "wait_avg_ms": round(self._wait_total / self._started * 1000, 1) if self._started else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 1),
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+oltp_executor = BoundedExecutor("oltp", DB_EXECUTOR_WORKERS, DB_EXECUTOR_QUEUE)
+report_executor = BoundedExecutor("report", REPORT_EXECUTOR_WORKERS, REPORT_EXECUTOR_QUEUE)
+
+
+async def run_db(func, *args):
+    """Берёт соединение из пула и выполняет func(connection, *args) в OLTP-потоке."""
+    async with db_pool.connection() as connection:
+        return await oltp_executor.run(func, connection, *args)
+
+
+async def run_report(func, *args):
+    """То же, что run_db, но в отдельном пуле для тяжёлых отчётов."""
+    async with db_pool.connection() as connection:
+        return await report_executor.run(func, connection, *args)
+
+
+class TTLCache:
+    """In-process кэш с LRU-вытеснением и истечением записей через ttl секунд; только из event loop."""
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self._ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self._maxsize, "hits": self.hits, "misses": self.misses}
+
+
+SEND_PRIORITIES = {"interactive": 0, "card_edit": 1, "broadcast": 2, "admin_copy": 3}
+send_priority = contextvars.ContextVar("send_priority", default="interactive")
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота: общий и поканальный лимиты запросов к Telegram с приоритетами."""
+
+    def __init__(self, rate, per_chat_interval, per_chat_burst):
+        self._rate = rate
+        self._per_chat_interval = per_chat_interval
+        self._per_chat_burst = per_chat_burst
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chats = {}  # chat_id -> [tokens, updated_at]
+        self._queue = []  # [priority, seq, chat_id, enqueued_at, future, class]
+        self._seq = 0
+        self._wakeup = None
+        self._task = None
+        self._metrics = {name: {"granted": 0, "wait_total": 0.0, "wait_max": 0.0} for name in SEND_PRIORITIES}
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        await self._acquire(chat_id, send_priority.get())
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.pause(e.retry_after)
+            raise
+
+    async def _acquire(self, chat_id, priority_class):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._queue.append([SEND_PRIORITIES.get(priority_class, 0), self._seq, chat_id, time.monotonic(),
+                            future, priority_class])
+        self._wakeup.set()
+        await future
+
+    def _chat_ready_at(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            return now
+        tokens = min(self._per_chat_burst, bucket[0] + (now - bucket[1]) / self._per_chat_interval)
+        return now if tokens >= 1 else now + (1 - tokens) * self._per_chat_interval
+
+    def _take_chat_token(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        tokens = self._per_chat_burst if bucket is None else \
+            min(self._per_chat_burst, bucket[0] + (now - bucket[1]) / self._per_chat_interval)
+        self._chats[chat_id] = [tokens - 1, now]
+        if len(self._chats) > 10000:
+            # Полные bucket-ы ничем не отличаются от отсутствующих.
+            self._chats = {key: value for key, value in self._chats.items()
+                           if value[0] + (now - value[1]) / self._per_chat_interval < self._per_chat_burst}
+
+    async def _run(self):
+        while True:
+            self._queue = [entry for entry in self._queue if not entry[4].done()]
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                continue
+
+            ready = [entry for entry in self._queue if self._chat_ready_at(entry[2], now) <= now]
+            if not ready:
+                next_at = min(self._chat_ready_at(entry[2], now) for entry in self._queue)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = min(ready)
+            self._queue.remove(entry)
+            _, _, chat_id, enqueued_at, future, priority_class = entry
+            self._tokens -= 1
+            self._take_chat_token(chat_id, now)
+            metrics = self._metrics.setdefault(priority_class, {"granted": 0, "wait_total": 0.0, "wait_max": 0.0})
+            metrics["granted"] += 1
+            metrics["wait_total"] += now - enqueued_at
+            metrics["wait_max"] = max(metrics["wait_max"], now - enqueued_at)
+            future.set_result(None)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        queued = {}
+        for entry in self._queue:
+            if not entry[4].done():
+                queued[entry[5]] = queued.get(entry[5], 0) + 1
+        return {
+            name: {
+                "queued": queued.get(name, 0),
+                "granted": metrics["granted"],
+                "wait_avg_ms": round(metrics["wait_total"] / metrics["granted"] * 1000, 1) if metrics["granted"] else 0.0,
+                "wait_max_ms": round(metrics["wait_max"] * 1000, 1),
+            }
+            for name, metrics in self._metrics.items()
+        }
+
+
+class DeliveryResult(namedtuple("DeliveryResult", "recipient ok value error")):
+    pass
+
+
+class Broadcaster:
+    """Параллельная рассылка с повтором запроса после 429."""
+
+    def __init__(self, concurrency, max_retries, priority):
+        self._concurrency = concurrency
+        self._max_retries = max_retries
+        self._priority = priority
+
+    async def call(self, chat_id, factory, priority=None):
+        token = send_priority.set(priority or self._priority)
+        try:
+            for attempt in range(self._max_retries + 1):
+                try:
+                    return await factory()
+                except TelegramRetryAfter as e:
+                    if attempt == self._max_retries:
+                        raise
+                    # SendScheduler уже приостановил отправку на retry_after.
+                    logging.warning(f"Flood control для {chat_id}: ждём {e.retry_after} с")
+        finally:
+            send_priority.reset(token)
+
+    async def broadcast(self, recipients, deliver):
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def run(recipient):
+            async with semaphore:
+                try:
+                    return DeliveryResult(recipient, True, await deliver(recipient), None)
+                except Exception as e:
+                    return DeliveryResult(recipient, False, None, e)
+
+        return await asyncio.gather(*(run(recipient) for recipient in recipients))
+
+
+class CardUpdater:
+    """Параллельная правка разосланных карточек заявки; повторные правки одной карточки схлопываются."""
+
+    def __init__(self, bot, concurrency, max_retries, history_size=10000):
+        self._bot = bot
+        self._broadcaster = Broadcaster(concurrency, max_retries, priority="card_edit")
+        self._pending = {}  # (chat_id, message_id) -> последний запрошенный текст
+        self._last_text = OrderedDict()  # (chat_id, message_id) -> отправленный текст
+        self._history_size = history_size
+        self.sent = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def _remember(self, key, text):
+        self._last_text[key] = text
+        self._last_text.move_to_end(key)
+        if len(self._last_text) > self._history_size:
+            self._last_text.popitem(last=False)
+
+    async def update(self, messages, text):
+        targets = []
+        for chat_id, message_id in messages:
+            if not (chat_id and message_id):
+                continue
+            key = (chat_id, message_id)
+            if key in self._pending:
+                # Правка этой карточки уже идёт — она отправит самый свежий текст.
+                self._pending[key] = text
+                self.coalesced += 1
+            elif self._last_text.get(key) == text:
+                self.skipped += 1
+            else:
+                self._pending[key] = text
+                targets.append(key)
+
+        async def edit(key):
+            chat_id, message_id = key
+            try:
+                while True:
+                    new_text = self._pending[key]
+                    if self._last_text.get(key) != new_text:
+                        try:
+                            await self._broadcaster.call(chat_id, lambda: self._bot.edit_message_text(
+                                chat_id=chat_id,
+                                message_id=message_id,
+                                text=new_text,
+                                reply_markup=None
+                            ))
+                            self.sent += 1
+                        except TelegramBadRequest as e:
+                            if "message is not modified" not in str(e):
+                                raise
+                        self._remember(key, new_text)
+                    if self._pending[key] == new_text:
+                        return
+            finally:
+                self._pending.pop(key, None)
+
+        results = await self._broadcaster.broadcast(targets, edit)
+        for result in results:
+            if not result.ok:
+                logging.error(f"Ошибка обновления сообщения {result.recipient[1]}: {result.error}")
+        return results
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "coalesced": self.coalesced, "skipped": self.skipped,
+                "in_flight": len(self._pending)}
+
+
+def db_fsm_load(connection, storage_key):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT state, data FROM fsm_storage WHERE storage_key = %s", (storage_key,))
+        row = cursor.fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+
+def db_fsm_save_many(connection, items):
+    """items: {storage_key: (state, data)}; пустые записи удаляются."""
+    upserts = [(storage_key, state, json.dumps(data, ensure_ascii=False))
+               for storage_key, (state, data) in items.items() if state is not None or data]
+    deletes = [storage_key for storage_key, (state, data) in items.items() if state is None and not data]
+    with connection.cursor() as cursor:
+        if upserts:
+            cursor.executemany(
+                "INSERT INTO fsm_storage (storage_key, state, data) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE state = VALUES(state), data = VALUES(data)",
+                upserts
+            )
+        if deletes:
+            cursor.executemany("DELETE FROM fsm_storage WHERE storage_key = %s", deletes)
+        connection.commit()
+
+
+def db_fsm_expire(connection, idle_seconds, exclude, states=None):
+    """
+    Удаляет записи без изменений дольше idle_seconds, кроме exclude; при states —
+    только записи без состояния или с состоянием из states. Возвращает [(key, state)].
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT storage_key, state FROM fsm_storage WHERE updated_at < NOW(6) - INTERVAL %s SECOND",
+            (idle_seconds,)
+        )
+        expired = [(storage_key, state) for storage_key, state in cursor.fetchall()
+                   if storage_key not in exclude and (states is None or state is None or state in states)]
+        if expired:
+            cursor.executemany(
+                "DELETE FROM fsm_storage WHERE storage_key = %s AND updated_at < NOW(6) - INTERVAL %s SECOND",
+                [(storage_key, idle_seconds) for storage_key, _ in expired]
+            )
+        connection.commit()
+    return expired
+
+
+class MySQLKV:
+    """Бэкенд PersistentStorage на таблице fsm_storage (миграция 005)."""
+
+    async def load(self, storage_key):
+        return await run_db(db_fsm_load, storage_key)
+
+    async def save_many(self, items):
+        await run_db(db_fsm_save_many, items)
+
+    async def expire(self, idle_seconds, exclude, states=None):
+        return await run_db(db_fsm_expire, idle_seconds, exclude, states)
+
+
+class MemoryKV:
+    """Бэкенд PersistentStorage в памяти процесса: для локального запуска без БД."""
+
+    def __init__(self):
+        self._data = {}  # storage_key -> (state, json, updated_at)
+
+    async def load(self, storage_key):
+        item = self._data.get(storage_key)
+        return (item[0], json.loads(item[1])) if item else None
+
+    async def save_many(self, items):
+        for storage_key, (state, data) in items.items():
+            if state is None and not data:
+                self._data.pop(storage_key, None)
+            else:
+                self._data[storage_key] = (state, json.dumps(data, ensure_ascii=False), time.time())
+
+    async def expire(self, idle_seconds, exclude, states=None):
+        cutoff = time.time() - idle_seconds
+        expired = [(storage_key, item[0]) for storage_key, item in self._data.items()
+                   if item[2] < cutoff and storage_key not in exclude
+                   and (states is None or item[0] is None or item[0] in states)]
+        for storage_key, _ in expired:
+            del self._data[storage_key]
+        return expired
+
+
+class FSMEntry:
+    __slots__ = ("state", "data", "chat_id", "touched_at")
+
+    def __init__(self, state, data, chat_id):
+        self.state = state
+        self.data = data
+        self.chat_id = chat_id
+        self.touched_at = time.monotonic()
+
+
+class PersistentStorage(BaseStorage):
+    """FSM-хранилище, переживающее рестарт: кэш в памяти и пакетная запись в бэкенд раз в flush_interval."""
+
+    def __init__(self, backend, flush_interval=0.5, cache_size=10000, idle_ttl=21600.0, on_expire=None,
+                 expirable_states=None):
+        self._backend = backend
+        self._flush_interval = flush_interval
+        self._cache_size = cache_size
+        self._idle_ttl = idle_ttl
+        self._expirable_states = expirable_states
+        self._on_expire = on_expire
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()  # storage_key -> FSMEntry, в порядке последнего обращения
+        self._dirty = set()
+        self._flush_task = None
+        self._sweep_task = None
+        self.flushes = 0
+        self.flush_errors = 0
+        self.unloaded = 0
+        self.expired = 0
+
+    async def _entry(self, key: StorageKey):
+        storage_key = self._key_builder.build(key)
+        entry = self._cache.get(storage_key)
+        if entry is None:
+            loaded = await self._backend.load(storage_key)
+            # Пока шла загрузка, ключ мог быть уже записан — свежая запись важнее.
+            entry = self._cache.get(storage_key)
+            if entry is None:
+                state, data = loaded if loaded else (None, {})
+                entry = self._cache[storage_key] = FSMEntry(state, data, key.chat_id)
+                self._unload_overflow()
+        self._cache.move_to_end(storage_key)
+        entry.touched_at = time.monotonic()
+        return storage_key, entry
+
+    def _unload_overflow(self):
+        """Выгружает из памяти самые старые записи, уже сохранённые в бэкенде."""
+        if len(self._cache) <= self._cache_size:
+            return
+        for storage_key in list(self._cache)[:-1]:  # самую свежую запись не трогаем
+            if len(self._cache) <= self._cache_size:
+                break
+            if storage_key not in self._dirty:
+                del self._cache[storage_key]
+                self.unloaded += 1
+
+    def _mark_dirty(self, storage_key):
+        self._dirty.add(storage_key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        items = {storage_key: (self._cache[storage_key].state, self._cache[storage_key].data)
+                 for storage_key in keys if storage_key in self._cache}
+        try:
+            await self._backend.save_many(items)
+            self.flushes += 1
+        except asyncio.CancelledError:
+            self._dirty |= keys
+            raise
+        except Exception as e:
+            self.flush_errors += 1
+            logging.error(f"Не удалось сохранить FSM ({len(items)} записей), повторим: {e}")
+            self._dirty |= keys
+        self._unload_overflow()
+
+    def start(self) -> None:
+        if self._idle_ttl > 0 and self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        interval = min(self._idle_ttl / 10, 60.0)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Ошибка очистки брошенных диалогов FSM: {e}")
+
+    async def sweep(self):
+        """Очищает диалоги, к которым не обращались дольше idle_ttl."""
+        cutoff = time.monotonic() - self._idle_ttl
+        notify = []
+        for storage_key, entry in list(self._cache.items()):
+            if entry.touched_at >= cutoff:
+                break  # дальше только более свежие записи
+            if entry.state is None and not entry.data:
+                if storage_key not in self._dirty:
+                    del self._cache[storage_key]
+                continue
+            if self._expirable_states is not None and entry.state is not None \
+                    and entry.state not in self._expirable_states:
+                continue
+            # Пустая запись остаётся в кэше до сохранения, чтобы старое
+            # состояние не перечиталось из бэкенда раньше удаления.
+            state = entry.state
+            entry.state, entry.data = None, {}
+            self._mark_dirty(storage_key)
+            self.expired += 1
+            if state is not None:
+                notify.append(entry.chat_id)
+
+        # Записи, которые есть только в бэкенде (например, с прошлого запуска).
+        for storage_key, state in await self._backend.expire(
+                self._idle_ttl, set(self._cache) | self._dirty, self._expirable_states):
+            self.expired += 1
+            if state is not None:
+                notify.append(int(storage_key.split(self._key_builder.separator)[2]))
+
+        if notify:
+            logging.info(f"FSM: истекло {len(notify)} брошенных диалогов")
+            if self._on_expire is not None:
+                await self._on_expire(notify)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        storage_key, entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key)
+
+    async def get_state(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        storage_key, entry = await self._entry(key)
+        entry.data = dict(data)
+        self._mark_dirty(storage_key)
+
+    async def get_data(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry.data.copy()
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "dirty": len(self._dirty), "flushes": self.flushes,
+                "flush_errors": self.flush_errors, "unloaded": self.unloaded, "expired": self.expired}
+
+    async def close(self) -> None:
+        for task in (self._sweep_task, self._flush_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._sweep_task = self._flush_task = None
+        await self.flush()
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """Собирает альбом (сообщения с одним media_group_id) в один вызов хендлера."""
+
+    def __init__(self, latency, states):
+        self._latency = latency
+        self._states = set(states)
+        self._albums = {}  # (chat_id, media_group_id) -> [Message]
+
+    async def __call__(self, handler, event, data):
+        if not event.media_group_id or not event.photo:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        self._albums[key] = album = [event]
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            del self._albums[key]
+        album.sort(key=lambda message: message.message_id)
+        data["album"] = album
+        return await handler(album[0], data)
+
+    async def unpack(self, handler, event, data):
+        album = data.get("album")
+        if album is None or data.get("raw_state") in self._states:
+            return await handler(event, data)
+        del data["album"]
+        result = None
+        for message in album:
+            data["raw_state"] = await data["state"].get_state()
+            result = await handler(message, data)
+        return result
+
+
+class ChatSerializer(BaseMiddleware):
+    """Апдейты одного чата обрабатываются строго по очереди, разных чатов — параллельно."""
+
+    def __init__(self, max_workers, chat_stats_size=1000):
+        self._max_workers = max_workers
+        self._workers = asyncio.Semaphore(max_workers)
+        self._chats = {}  # chat_id -> [Lock, сколько апдейтов в очереди и в работе]
+        self._chat_stats = OrderedDict()  # chat_id -> [processed, wait_total, wait_max]
+        self._chat_stats_size = chat_stats_size
+        self._running = 0
+        self.processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        chat_id = chat.id if chat else (user.id if user else None)
+        if chat_id is None:
+            return await handler(event, data)
+
+        slot = self._chats.get(chat_id)
+        if slot is None:
+            slot = self._chats[chat_id] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        enqueued_at = time.monotonic()
+        try:
+            async with slot[0]:
+                async with self._workers:
+                    self._record_wait(chat_id, time.monotonic() - enqueued_at)
+                    self._running += 1
+                    try:
+                        # FSMContextMiddleware прочитал состояние ещё до очереди чата; пока апдейт
+                        # ждал, предыдущий хендлер мог его сменить — перечитываем перед фильтрами.
+                        state = data.get("state")
+                        if state is not None:
+                            data["raw_state"] = await state.get_state()
+                        return await handler(event, data)
+                    finally:
+                        self._running -= 1
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._chats[chat_id]
+
+    def _record_wait(self, chat_id, waited):
+        self.processed += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        chat_stats = self._chat_stats.pop(chat_id, None) or [0, 0.0, 0.0]
+        chat_stats[0] += 1
+        chat_stats[1] += waited
+        chat_stats[2] = max(chat_stats[2], waited)
+        self._chat_stats[chat_id] = chat_stats
+        if len(self._chat_stats) > self._chat_stats_size:
+            self._chat_stats.popitem(last=False)
+
+    def stats(self) -> dict:
+        queues = sorted(((slot[1], chat_id) for chat_id, slot in self._chats.items()), reverse=True)[:5]
+        slowest = sorted(self._chat_stats.items(), key=lambda item: item[1][2], reverse=True)[:5]
+        return {
+            "workers": self._max_workers,
+            "running": self._running,
+            "chats_busy": len(self._chats),
+            "processed": self.processed,
+            "wait_avg_ms": round(self._wait_total / self.processed * 1000, 1) if self.processed else 0.0,
+            "wait_max_ms": round(self._wait_max * 1000, 1),
+            "longest_queues": {chat_id: length for length, chat_id in queues},
+            "slowest_chats_ms": {chat_id: {"avg": round(total / count * 1000, 1), "max": round(wait_max * 1000, 1)}
+                                 for chat_id, (count, total, wait_max) in slowest},
+        }
+
+
+def album_file_ids(message, album):
+    """file_id самого большого размера для каждого фото альбома (или одного сообщения)."""
+    return [item.photo[-1].file_id for item in (album or [message]) if item.photo]
+
+
+class OutboxMessage(namedtuple("OutboxMessage", "chat_id method payload")):
+    __slots__ = ()
+
+
+def outbox_message(chat_id, text, reply_markup=None):
+    markup = reply_markup.model_dump(exclude_none=True) if reply_markup else None
+    return OutboxMessage(chat_id, "send_message", {"text": text, "reply_markup": markup})
+
+
+def outbox_media_group(chat_id, photos, caption=None, priority=None):
+    # Альбом — минимум из двух фото; одно уходит обычным send_photo.
+    if len(photos) == 1:
+        method, payload = "send_photo", {"photo": photos[0], "caption": caption}
+    else:
+        method, payload = "send_media_group", {"photos": list(photos), "caption": caption}
+    if priority:
+        payload["priority"] = priority
+    return OutboxMessage(chat_id, method, payload)
+
+
+def db_enqueue_outbox(cursor, idempotency_key, messages):
+    """
+    Ставит сообщения в outbox в текущей транзакции (commit делает вызывающий).
+    Ключ idempotency_key:N уникален: повтор той же операции не задваивает отправку.
+    """
+    cursor.executemany(
+        "INSERT IGNORE INTO outbox (idempotency_key, chat_id, method, payload) VALUES (%s, %s, %s, %s)",
+        [(f"{idempotency_key}:{index}", message.chat_id, message.method,
+          json.dumps(message.payload, ensure_ascii=False))
+         for index, message in enumerate(messages) if message.chat_id]
+    )
+
+
+def db_claim_outbox(connection, batch_size, lease_seconds):
+    """
+    Забирает пачку готовых к отправке сообщений: по одному, самому раннему, на чат,
+    чтобы сообщения в чат уходили строго по порядку. Выбранные строки «арендуются»
+    сдвигом next_attempt_at: если процесс упадёт, они снова станут доступны.
+    """
+    with connection.cursor() as cursor:
+        connection.begin()
+        cursor.execute(
+            """
+            SELECT o.id, o.chat_id, o.method, o.payload, o.attempts
+            FROM outbox o
+            WHERE o.status = 'pending'
+              AND o.next_attempt_at <= NOW(6)
+              AND NOT EXISTS (SELECT 1 FROM outbox e
+                              WHERE e.chat_id = o.chat_id AND e.status = 'pending' AND e.id < o.id)
+            ORDER BY o.id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """,
+            (batch_size,)
+        )
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"UPDATE outbox SET next_attempt_at = NOW(6) + INTERVAL %s SECOND "
+                f"WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                (lease_seconds, *ids)
+            )
+        connection.commit()
+    return rows
+
+
+def db_finish_outbox(connection, sent_ids, failures):
+    """failures: [(id, error, retry_in_seconds | None)]; None — больше не пытаться."""
+    with connection.cursor() as cursor:
+        if sent_ids:
+            cursor.execute(
+                f"UPDATE outbox SET status = 'sent', sent_at = NOW(6), attempts = attempts + 1 "
+                f"WHERE id IN ({', '.join(['%s'] * len(sent_ids))})",
+                sent_ids
+            )
+        if failures:
+            cursor.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = %s, "
+                "status = IF(%s IS NULL, 'failed', 'pending'), "
+                "next_attempt_at = NOW(6) + INTERVAL COALESCE(%s, 0) SECOND WHERE id = %s",
+                [(error[:1000], retry_in, retry_in, outbox_id) for outbox_id, error, retry_in in failures]
+            )
+        connection.commit()
+
+
+def db_purge_outbox(connection, retention_days):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND sent_at < NOW(6) - INTERVAL %s DAY LIMIT 10000",
+            (retention_days,)
+        )
+        connection.commit()
+        return cursor.rowcount
+
+
+class OutboxDispatcher:
+    """Фоновая доставка сообщений из таблицы outbox с повторами, «хотя бы один раз»."""
+
+    def __init__(self, bot, broadcaster, batch_size, poll_interval, lease, max_attempts, retention_days):
+        self._bot = bot
+        self._broadcaster = broadcaster
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease = lease
+        self._max_attempts = max_attempts
+        self._retention_days = retention_days
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        purged_at = 0.0
+        while True:
+            try:
+                if time.monotonic() - purged_at > 3600:
+                    purged_at = time.monotonic()
+                    await run_db(db_purge_outbox, self._retention_days)
+                self._wakeup.clear()
+                rows = await run_db(db_claim_outbox, self._batch_size, self._lease)
+                if rows:
+                    await self._deliver(rows)
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка обработки outbox: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, chat_id, method, payload):
+        if method == "send_message":
+            markup = payload.get("reply_markup")
+            return await self._bot.send_message(
+                chat_id,
+                payload["text"],
+                reply_markup=InlineKeyboardMarkup.model_validate(markup) if markup else None
+            )
+        if method == "send_photo" or method == "send_media_group" and len(payload["photos"]) == 1:
+            photo = payload["photo"] if method == "send_photo" else payload["photos"][0]
+            return await self._bot.send_photo(chat_id=chat_id, photo=photo, caption=payload.get("caption"))
+        if method == "send_media_group":
+            media = [types.InputMediaPhoto(media=photo) for photo in payload["photos"]]
+            media[0].caption = payload.get("caption")
+            return await self._bot.send_media_group(chat_id=chat_id, media=media)
+        raise ValueError(f"Неизвестный метод outbox: {method}")
+
+    async def _deliver(self, rows):
+        async def deliver(row):
+            outbox_id, chat_id, method, payload, attempts = row
+            payload = json.loads(payload)
+            await self._broadcaster.call(chat_id, lambda: self._send(chat_id, method, payload),
+                                         priority=payload.get("priority"))
+
+        sent_ids, failures = [], []
+        for result in await self._broadcaster.broadcast(rows, deliver):
+            outbox_id, chat_id, _, _, attempts = result.recipient
+            if result.ok:
+                sent_ids.append(outbox_id)
+                continue
+            permanent = isinstance(result.error, (TelegramForbiddenError, TelegramBadRequest, ValueError))
+            if permanent or attempts + 1 >= self._max_attempts:
+                self.failed += 1
+                retry_in = None
+                logging.error(f"Outbox #{outbox_id} для {chat_id} не доставлено: {result.error}")
+            else:
+                self.retried += 1
+                retry_in = min(2 ** attempts * 5, 3600)
+                logging.warning(f"Outbox #{outbox_id} для {chat_id}: {result.error}, повтор через {retry_in} с")
+            failures.append((outbox_id, str(result.error), retry_in))
+        self.sent += len(sent_ids)
+        await run_db(db_finish_outbox, sent_ids, failures)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+
+send_scheduler = SendScheduler(TG_GLOBAL_RATE, TG_PER_CHAT_INTERVAL, TG_PER_CHAT_BURST)
+broadcaster = Broadcaster(BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES, priority="broadcast")
 
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+bot.session.middleware(send_scheduler)
+card_updater = CardUpdater(bot, CARD_EDIT_CONCURRENCY, BROADCAST_MAX_RETRIES)
+outbox = OutboxDispatcher(
+    bot, Broadcaster(BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES, priority="interactive"),
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_DAYS
+)
 
-ph_router = Router()
 
-dp.include_router(ph_router)
+async def notify_fsm_expired(chat_ids):
+    async def deliver(chat_id):
+        await broadcaster.call(chat_id, lambda: bot.send_message(
+            chat_id,
+            "⌛ Незавершённое действие отменено из-за долгого бездействия. Откройте /menu, чтобы начать заново.",
+            reply_markup=ReplyKeyboardRemove()
+        ))
 
-logging.basicConfig(level=logging.INFO)
+    for result in await broadcaster.broadcast(chat_ids, deliver):
+        if not result.ok:
+            logging.warning(f"Не удалось уведомить {result.recipient} об истечении диалога: {result.error}")
 
 
 class CompleteOrderStates(StatesGroup):
@@ -67,16 +1160,38 @@ class OtpStates(StatesGroup):
     code = State()
 
 
-INVITES_TABLE_DDL = """
-CREATE TABLE IF NOT EXISTS expert_invites (
-    code        VARCHAR(16) PRIMARY KEY,
-    created_by  BIGINT       NOT NULL,
-    created_at  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    used_by_tg  BIGINT       NULL,
-    used_at     TIMESTAMP    NULL
+storage = PersistentStorage(
+    MemoryKV() if FSM_STORAGE == "memory" else MySQLKV(),
+    flush_interval=FSM_FLUSH_INTERVAL,
+    cache_size=FSM_CACHE_SIZE,
+    idle_ttl=FSM_IDLE_TTL,
+    on_expire=notify_fsm_expired if FSM_EXPIRY_NOTICE else None,
+    # Истекают только черновики и вход: состояния работы над заявкой (сдача результата,
+    # доработка) восстановить нечем, и заявка навсегда осталась бы «В работе».
+    expirable_states={state.state for group in (CreateOrderStates, LoginStates, OtpStates)
+                      for state in group.__all_states__},
+)
+dp = Dispatcher(storage=storage)
+
+ph_router = Router()
+
+dp.include_router(ph_router)
+
+logging.basicConfig(level=logging.INFO)
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+MIGRATIONS_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version     VARCHAR(128) PRIMARY KEY,
+    applied_at  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP
 )
 """
 
+ER_DUP_KEYNAME = 1061
+ER_DUP_FIELDNAME = 1060
+
 
 def generate_otp(length: int = 8) -> str:
     alphabet = string.ascii_uppercase + string.digits
@@ -88,15 +1203,58 @@ def is_admin(tg_id) -> bool:
     return sid == str(ADMIN_ID_1) or sid == str(ADMIN_ID_2)
 
 
-def ensure_invites_table() -> None:
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        with connection.cursor() as cursor:
-            cursor.execute(INVITES_TABLE_DDL)
-            connection.commit()
-        connection.close()
-    except Exception as e:
-        logging.error(f"Не удалось создать таблицу expert_invites: {e}")
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Список (version, [statements]) из файлов NNN_name.sql в порядке версий."""
+    migrations = []
+    for file_name in sorted(os.listdir(directory)):
+        if not re.match(r"^\d+_.+\.sql$", file_name):
+            continue
+        with open(os.path.join(directory, file_name), encoding="utf-8") as file:
+            sql = file.read()
+        statements = [statement.strip() for statement in sql.split(";") if statement.strip()]
+        migrations.append((file_name[:-len(".sql")], statements))
+    return migrations
+
+
+def db_apply_migrations(connection, migrations):
+    """
+    Применяет ещё не применённые миграции и записывает их в schema_migrations.
+    GET_LOCK не даёт двум экземплярам бота мигрировать одновременно.
+    Повторное создание уже существующего индекса/колонки не считается ошибкой:
+    часть индексов могла быть создана вручную до появления миграций.
+    """
+    applied_now = []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK('phbot_migrations', 60)")
+        if not cursor.fetchone()[0]:
+            raise RuntimeError("Не удалось получить блокировку миграций")
+        try:
+            cursor.execute(MIGRATIONS_TABLE_DDL)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cursor.fetchall()}
+
+            for version, statements in migrations:
+                if version in applied:
+                    continue
+                for statement in statements:
+                    try:
+                        cursor.execute(statement)
+                    except pymysql.MySQLError as e:
+                        if e.args[0] not in (ER_DUP_KEYNAME, ER_DUP_FIELDNAME):
+                            raise
+                        logging.warning(f"Миграция {version}: {e.args[1]} — пропускаем")
+                cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+                connection.commit()
+                applied_now.append(version)
+        finally:
+            cursor.execute("DO RELEASE_LOCK('phbot_migrations')")
+    return applied_now
+
+
+async def apply_migrations() -> None:
+    applied = await run_db(db_apply_migrations, load_migrations())
+    for version in applied:
+        logging.info(f"Применена миграция {version}")
 
 
 class RevisionStates(StatesGroup):
@@ -113,6 +1271,21 @@ class RevisionReplyStates(StatesGroup):
     text = State()
 
 
+album_middleware = AlbumMiddleware(ALBUM_LATENCY, [
+    CreateOrderStates.photos.state,
+    CompleteOrderStates.result_photos.state,
+    RevisionStates.revision_photos.state,
+])
+dp.message.outer_middleware(album_middleware)
+# Регистрируется после AlbumMiddleware: альбом собирается до постановки в очередь чата,
+# иначе первое фото альбома ждало бы остальные, стоящие за ним в той же очереди.
+chat_serializer = ChatSerializer(UPDATE_WORKERS)
+dp.message.outer_middleware(chat_serializer)
+dp.callback_query.outer_middleware(chat_serializer)
+# Состояние проверяется уже в очереди чата, после обновления raw_state.
+dp.message.outer_middleware(album_middleware.unpack)
+
+
 RESET_BTN = "🔄 Сброс"
 
 
@@ -190,43 +1363,43 @@ async def cmd_start(message: types.Message):
     )
 
 
+def db_fetch_cancellable_orders(connection, tg_id):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+                       SELECT o.id, o.description
+                       FROM orders o
+                       WHERE o.expert_id = (SELECT id FROM users_expert WHERE tg_id = %s)
+                         AND o.status = 'Ожидает исполнителя'
+                       """, (tg_id,))
+        return cursor.fetchall()
+
+
 @dp.message(F.text == "Удалить заявку")
 async def delete_order_start(message: types.Message):
-    connection = pymysql.connect(**DB_CONFIG)
     try:
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                           SELECT o.id, o.description
-                           FROM orders o
-                           WHERE o.expert_id = (SELECT id FROM users_expert WHERE tg_id = %s)
-                             AND o.status = 'Ожидает исполнителя'
-                           """, (message.from_user.id,))
-
-            orders = cursor.fetchall()
-
-            if not orders:
-                await message.answer("❌ Нет активных заявок для отмены")
-                return
+        orders = await run_db(db_fetch_cancellable_orders, message.from_user.id)
 
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-            for order in orders:
-                keyboard.inline_keyboard.append([
-                    InlineKeyboardButton(
-                        text=f"#{order[0]} - {order[1][:30]}",
-                        callback_data=f"cancel_order_{order[0]}"
-                    )
-                ])
+        if not orders:
+            await message.answer("❌ Нет активных заявок для отмены")
+            return
 
-            await message.answer(
-                "Выберите заявку для отмены:",
-                reply_markup=keyboard
-            )
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+        for order in orders:
+            keyboard.inline_keyboard.append([
+                InlineKeyboardButton(
+                    text=f"#{order[0]} - {order[1][:30]}",
+                    callback_data=f"cancel_order_{order[0]}"
+                )
+            ])
+
+        await message.answer(
+            "Выберите заявку для отмены:",
+            reply_markup=keyboard
+        )
 
     except Exception as e:
         logging.error(f"Ошибка получения заявок: {e}")
         await message.answer("⚠️ Ошибка при загрузке заявок")
-    finally:
-        connection.close()
 
 
 @dp.callback_query(lambda c: c.data.startswith("cancel_order_"))
@@ -244,50 +1417,55 @@ async def confirm_cancel_order(callback: types.CallbackQuery):
     )
 
 
+def db_cancel_order(connection, order_id, tg_id):
+    """
+    Отменяет заявку эксперта, пока её никто не взял. Завершённые заявки не
+    отменяются, поэтому report_daily_rollup здесь не меняется.
+    Возвращает карточки [(tg_id, message_id)] или None, если отменять уже нельзя.
+    """
+    with connection.cursor() as cursor:
+        connection.begin()
+        cursor.execute("""
+                       UPDATE orders
+                       SET status = 'Отменено'
+                       WHERE id = %s
+                         AND status = 'Ожидает исполнителя'
+                         AND expert_id = (SELECT id FROM users_expert WHERE tg_id = %s)
+                       """, (order_id, tg_id))
+        if cursor.rowcount != 1:
+            connection.rollback()
+            return None
+
+        cursor.execute("""
+                       SELECT up.tg_id, om.message_id
+                       FROM order_messages om
+                                LEFT JOIN users_ph up ON om.ph_id = up.id
+                       WHERE order_id = %s
+                       """, (order_id,))
+        messages = cursor.fetchall()
+        connection.commit()
+        return messages
+
+
 @dp.callback_query(lambda c: c.data.startswith("confirm_cancel_"))
 async def process_cancel_order(callback: types.CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     user_id = callback.from_user.id
 
-    connection = pymysql.connect(**DB_CONFIG)
     try:
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                           UPDATE orders
-                           SET status = 'Отменено'
-                           WHERE id = %s
-                             AND expert_id = (SELECT id FROM users_expert WHERE tg_id = %s)
-                           """, (order_id, user_id))
-
-            cursor.execute("""
-                           SELECT up.tg_id, om.message_id
-                           FROM order_messages om
-                                    LEFT JOIN users_ph up ON om.ph_id = up.id
-                           WHERE order_id = %s
-                           """, (order_id,))
-
-            messages = cursor.fetchall()
-
-            for ph_id, message_id in messages:
-                try:
-                    await bot.edit_message_text(
-                        chat_id=ph_id,
-                        message_id=message_id,
-                        text=f"🚫 Заявка #{order_id} отменена экспертом",
-                        reply_markup=None
-                    )
-                except Exception as e:
-                    logging.error(f"Ошибка обновления сообщения: {e}")
+        messages = await run_db(db_cancel_order, order_id, user_id)
+        if messages is None:
+            await callback.message.edit_text(f"⚠️ Заявку #{order_id} уже нельзя отменить: её взяли в работу")
+            return
+        order_dispatcher.close(order_id)
 
-            connection.commit()
+        await callback.message.edit_text(f"✅ Заявка #{order_id} успешно отменена!")
 
-            await callback.message.edit_text(f"✅ Заявка #{order_id} успешно отменена!")
+        await card_updater.update(messages, f"🚫 Заявка #{order_id} отменена экспертом")
 
     except Exception as e:
         logging.error(f"Ошибка отмены заявки: {e}")
         await callback.message.edit_text("⚠️ Ошибка при отмене заявки")
-    finally:
-        connection.close()
 
 
 @dp.callback_query(lambda c: c.data == "cancel_action")
@@ -308,28 +1486,16 @@ async def process_login_input(message: types.Message, state: FSMContext):
     await message.answer("Введите ваш пароль:")
 
 
-@dp.message(LoginStates.password)
-async def process_password_input(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
-    login = user_data['login']
-    password = message.text
-
-    try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
-
+def db_find_user_by_credentials(connection, login, password):
+    """Возвращает ('expert', (name, surname)), ('ph', (name,)) или None."""
+    with connection.cursor() as cursor:
         cursor.execute(
             "SELECT name, surname FROM users_expert WHERE login = %s AND password = %s",
             (login, password)
         )
         expert = cursor.fetchone()
         if expert:
-            await message.answer(
-                f"Добро пожаловать, {expert[0]} {expert[1]}!",
-                reply_markup=expert_main_keyboard(),
-            )
-            await state.clear()
-            return
+            return "expert", expert
 
         cursor.execute(
             "SELECT name FROM users_ph WHERE login = %s AND password = %s",
@@ -337,11 +1503,32 @@ async def process_password_input(message: types.Message, state: FSMContext):
         )
         ph = cursor.fetchone()
         if ph:
+            return "ph", ph
+    return None
+
+
+@dp.message(LoginStates.password)
+async def process_password_input(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
+    login = user_data['login']
+    password = message.text
+
+    try:
+        found = await run_db(db_find_user_by_credentials, login, password)
+        if found and found[0] == "expert":
+            expert = found[1]
+            await message.answer(
+                f"Добро пожаловать, {expert[0]} {expert[1]}!",
+                reply_markup=expert_main_keyboard(),
+            )
+            return
+
+        if found and found[0] == "ph":
+            ph = found[1]
             await message.answer(
                 f"Добро пожаловать, {ph[0]}!",
                 reply_markup=ph_main_keyboard(),
             )
-            await state.clear()
             return
 
         await message.answer("❌ Неверный логин или пароль")
@@ -350,8 +1537,6 @@ async def process_password_input(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка при входе: {e}")
         await message.answer("⚠️ Произошла ошибка. Попробуйте позже.")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
 
@@ -364,48 +1549,56 @@ async def otp_start(message: types.Message, state: FSMContext):
     )
 
 
+def db_register_expert_by_invite(connection, tg_id, code, name, surname):
+    """Возвращает 'exists', 'invalid' или 'ok'."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM users_expert WHERE tg_id = %s",
+            (tg_id,),
+        )
+        if cursor.fetchone():
+            return "exists"
+
+        cursor.execute(
+            "SELECT code FROM expert_invites WHERE code = %s AND used_by_tg IS NULL",
+            (code,),
+        )
+        if not cursor.fetchone():
+            return "invalid"
+
+        login = f"tg_{tg_id}"
+
+        connection.begin()
+        cursor.execute(
+            """INSERT INTO users_expert (tg_id, name, surname, login, password, banned)
+               VALUES (%s, %s, %s, %s, %s, 0)""",
+            (tg_id, name, surname, login, ""),
+        )
+        cursor.execute(
+            """UPDATE expert_invites
+               SET used_by_tg = %s, used_at = NOW()
+               WHERE code = %s""",
+            (tg_id, code),
+        )
+        connection.commit()
+    return "ok"
+
+
 @dp.message(OtpStates.code)
 async def otp_process(message: types.Message, state: FSMContext):
     code = (message.text or "").strip().upper()
     tg_id = message.from_user.id
-    connection = None
+    name = (message.from_user.first_name or "Эксперт")[:64]
+    surname = (message.from_user.last_name or "")[:64]
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT id FROM users_expert WHERE tg_id = %s",
-                (tg_id,),
-            )
-            if cursor.fetchone():
-                await message.answer("Вы уже зарегистрированы как эксперт.")
-                await state.clear()
-                return
-
-            cursor.execute(
-                "SELECT code FROM expert_invites WHERE code = %s AND used_by_tg IS NULL",
-                (code,),
-            )
-            if not cursor.fetchone():
-                await message.answer("❌ Код недействителен или уже использован.")
-                await state.clear()
-                return
-
-            name = (message.from_user.first_name or "Эксперт")[:64]
-            surname = (message.from_user.last_name or "")[:64]
-            login = f"tg_{tg_id}"
-
-            cursor.execute(
-                """INSERT INTO users_expert (tg_id, name, surname, login, password, banned)
-                   VALUES (%s, %s, %s, %s, %s, 0)""",
-                (tg_id, name, surname, login, ""),
-            )
-            cursor.execute(
-                """UPDATE expert_invites
-                   SET used_by_tg = %s, used_at = NOW()
-                   WHERE code = %s""",
-                (tg_id, code),
-            )
-            connection.commit()
+        result = await run_db(db_register_expert_by_invite, tg_id, code, name, surname)
+        invalidate_user_role(tg_id)
+        if result == "exists":
+            await message.answer("Вы уже зарегистрированы как эксперт.")
+            return
+        if result == "invalid":
+            await message.answer("❌ Код недействителен или уже использован.")
+            return
 
         await message.answer(
             f"✅ Готово! Добро пожаловать, {name}!",
@@ -415,28 +1608,25 @@ async def otp_process(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка OTP-регистрации: {e}")
         await message.answer("⚠️ Произошла ошибка. Попробуйте позже.")
     finally:
-        try:
-            if connection is not None:
-                connection.close()
-        except Exception:
-            pass
         await state.clear()
 
 
+def db_create_invite(connection, code, created_by):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO expert_invites (code, created_by) VALUES (%s, %s)",
+            (code, created_by),
+        )
+        connection.commit()
+
+
 @dp.message(Command("invite"))
 async def cmd_invite(message: types.Message):
     if not is_admin(message.from_user.id):
         return
     code = generate_otp(8)
-    connection = None
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO expert_invites (code, created_by) VALUES (%s, %s)",
-                (code, message.from_user.id),
-            )
-            connection.commit()
+        await run_db(db_create_invite, code, message.from_user.id)
         await message.answer(
             f"🔑 Код приглашения для нового эксперта:\n\n`{code}`\n\n"
             "Перешлите его новому эксперту. Код одноразовый.",
@@ -445,27 +1635,23 @@ async def cmd_invite(message: types.Message):
     except Exception as e:
         logging.error(f"Ошибка /invite: {e}")
         await message.answer("⚠️ Не удалось создать код.")
-    finally:
-        try:
-            if connection is not None:
-                connection.close()
-        except Exception:
-            pass
+
+
+def db_fetch_active_invites(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT code, created_at FROM expert_invites "
+            "WHERE used_by_tg IS NULL ORDER BY created_at DESC"
+        )
+        return cursor.fetchall()
 
 
 @dp.message(Command("invites"))
 async def cmd_invites(message: types.Message):
     if not is_admin(message.from_user.id):
         return
-    connection = None
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT code, created_at FROM expert_invites "
-                "WHERE used_by_tg IS NULL ORDER BY created_at DESC"
-            )
-            rows = cursor.fetchall()
+        rows = await run_db(db_fetch_active_invites)
         if not rows:
             await message.answer("Активных кодов нет.")
             return
@@ -477,12 +1663,17 @@ async def cmd_invites(message: types.Message):
     except Exception as e:
         logging.error(f"Ошибка /invites: {e}")
         await message.answer("⚠️ Не удалось получить список.")
-    finally:
-        try:
-            if connection is not None:
-                connection.close()
-        except Exception:
-            pass
+
+
+def db_revoke_invite(connection, code):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM expert_invites WHERE code = %s AND used_by_tg IS NULL",
+            (code,),
+        )
+        deleted = cursor.rowcount
+        connection.commit()
+    return deleted
 
 
 @dp.message(Command("revoke"))
@@ -494,16 +1685,8 @@ async def cmd_revoke(message: types.Message):
         await message.answer("Использование: /revoke <код>")
         return
     code = parts[1].strip().upper()
-    connection = None
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM expert_invites WHERE code = %s AND used_by_tg IS NULL",
-                (code,),
-            )
-            deleted = cursor.rowcount
-            connection.commit()
+        deleted = await run_db(db_revoke_invite, code)
         if deleted:
             await message.answer(f"✅ Код `{code}` удалён.", parse_mode="Markdown")
         else:
@@ -511,25 +1694,15 @@ async def cmd_revoke(message: types.Message):
     except Exception as e:
         logging.error(f"Ошибка /revoke: {e}")
         await message.answer("⚠️ Не удалось удалить код.")
-    finally:
-        try:
-            if connection is not None:
-                connection.close()
-        except Exception:
-            pass
 
 
 @dp.message(F.text == "Создать заявку")
 async def create_order_start(message: types.Message, state: FSMContext):
-    connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-    cursor = connection.cursor()
-    cursor.execute(
-        "SELECT tg_id, banned FROM users_expert WHERE tg_id = %s",
-        (message.from_user.id),  # type: ignore
-    )
-    ban = cursor.fetchone()[1]  # type: ignore
-    print(ban)
-    if ban == 0:  # type: ignore
+    role = await get_user_role(message.from_user.id)
+    if not role.expert_id:
+        await message.answer("❌ Вы не зарегистрированы как эксперт!")
+        return
+    if role.banned == 0:  # type: ignore
         await state.set_state(CreateOrderStates.description)
         await message.answer("Введите описание заявки:", reply_markup=types.ReplyKeyboardRemove())
     else:  # type: ignore
@@ -548,7 +1721,7 @@ async def process_order_description(message: types.Message, state: FSMContext):
 
 
 @dp.message(CreateOrderStates.photos, F.photo)
-async def process_order_photos(message: types.Message, state: FSMContext):
+async def process_order_photos(message: types.Message, state: FSMContext, album=None):
     user_data = await state.get_data()
     photos = user_data.get('photos', [])
 
@@ -556,13 +1729,16 @@ async def process_order_photos(message: types.Message, state: FSMContext):
         await message.answer("Достигнут максимум 6 фотографий!")
         return
 
-    photos.append(message.photo[-1].file_id)  # type: ignore
+    new_photos = album_file_ids(message, album)
+    skipped = max(0, len(photos) + len(new_photos) - 6)
+    photos.extend(new_photos[:len(new_photos) - skipped])
     await state.update_data(photos=photos)
 
     if len(photos) < 6:
         await message.answer(f"Добавлено фото {len(photos)}/6. Отправьте ещё или нажмите 'Завершить'")
     else:
-        await message.answer("Максимум достигнут. Создаем заявку...")
+        await message.answer("Максимум достигнут. Создаем заявку..."
+                             + (f" Лишние фото ({skipped}) не добавлены." if skipped else ""))
         await save_order_data(message, state)
 
 
@@ -584,35 +1760,39 @@ def format_order_card(order_id, expert_id, description, status_line):
     )
 
 
-async def save_order_data(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
-    expert_id = await get_expert_id(message.from_user.id)  # type: ignore
-
-    keyboard = expert_main_keyboard()
-
-    try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
-
+def db_insert_order(connection, expert_id, description, photos):
+    with connection.cursor() as cursor:
+        connection.begin()
         cursor.execute(
             """INSERT INTO orders
                    (expert_id, description, status)
                VALUES (%s, %s, 'Ожидает исполнителя')""",
-            (expert_id, user_data['description'])
+            (expert_id, description)
         )
         order_id = cursor.lastrowid
 
-        for photo_id in user_data.get('photos', []):
-            cursor.execute(
+        if photos:
+            cursor.executemany(
                 """INSERT INTO order_photos
                        (order_id, photo_url)
                    VALUES (%s, %s)""",
-                (order_id, photo_id)
+                [(order_id, photo_id) for photo_id in photos]
             )
 
         connection.commit()
+    return order_id
+
+
+async def save_order_data(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
+    expert_id = await get_expert_id(message.from_user.id)  # type: ignore
 
-        await send_order_to_ph(order_id, expert_id, user_data['description'], user_data.get('photos', []))
+    keyboard = expert_main_keyboard()
+
+    try:
+        order_id = await run_db(db_insert_order, expert_id, user_data['description'], user_data.get('photos', []))
+
+        await order_dispatcher.dispatch(order_id, expert_id, user_data['description'], user_data.get('photos', []))
 
         await message.answer("✅ Заявка успешно создана!", reply_markup=keyboard)
 
@@ -620,40 +1800,115 @@ async def save_order_data(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка создания заявки: {e}")
         await message.answer("❌ Ошибка при создании заявки")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
 
-async def get_expert_id(user_id):
-    try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
+UserRole = namedtuple("UserRole", "ph_id expert_id banned")
+
+
+role_cache = TTLCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
+
+
+def db_fetch_user_role(connection, tg_id):
+    with connection.cursor() as cursor:
         cursor.execute(
-            "SELECT id FROM users_expert WHERE tg_id = %s",
-            (user_id,)
+            """SELECT 'ph', id, 0 FROM users_ph WHERE tg_id = %s
+               UNION ALL
+               SELECT 'expert', id, banned FROM users_expert WHERE tg_id = %s""",
+            (tg_id, tg_id)
         )
-        return cursor.fetchone()[0]  # type: ignore
-    except Exception as e:
-        logging.error(f"Ошибка получения expert_id: {e}")
-        return None
+        rows = cursor.fetchall()
+    ph_id = expert_id = banned = None
+    for role, user_id, user_banned in rows:
+        if role == "ph":
+            ph_id = user_id
+        else:
+            expert_id, banned = user_id, user_banned
+    return UserRole(ph_id, expert_id, banned)
+
+
+async def get_user_role(tg_id):
+    """Роль пользователя по tg_id; гости (все поля None) не кэшируются — добавленного в БД видно сразу."""
+    role = role_cache.get(tg_id)
+    if role is None:
+        role = await run_db(db_fetch_user_role, tg_id)
+        if role.ph_id or role.expert_id:
+            role_cache.set(tg_id, role)
+    return role
+
+
+def invalidate_user_role(tg_id):
+    role_cache.invalidate(tg_id)
+
+
+async def get_expert_id(user_id):
+    try:
+        return (await get_user_role(user_id)).expert_id
+    except Exception as e:
+        logging.error(f"Ошибка получения expert_id: {e}")
+        return None
 
 
 async def get_ph_id(user_id):
     try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT id FROM users_ph WHERE tg_id = %s",
-            (user_id,)
-        )
-        result = cursor.fetchone()
-        return result[0] if result else None
+        return (await get_user_role(user_id)).ph_id
     except Exception as e:
         logging.error(f"Ошибка получения ph_id: {e}")
         return None
 
 
+def db_take_order(connection, order_id, ph_id):
+    """
+    Атомарно закрепляет заявку за исполнителем.
+
+    Один условный UPDATE: заявка должна ждать исполнителя, а у исполнителя
+    не должно быть другой заявки «В работе». Успех определяется по числу
+    изменённых строк, поэтому при одновременных нажатиях выигрывает ровно один.
+    Возвращает (результат, данные): 'ok', 'busy', 'cancelled', 'missing' или 'taken'.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+                       UPDATE orders o
+                           LEFT JOIN orders busy
+                           ON busy.ph_id = %s AND busy.status = 'В работе'
+                       SET o.status   = 'В работе',
+                           o.ph_id    = %s,
+                           o.taken_at = NOW()
+                       WHERE o.id = %s
+                         AND o.status = 'Ожидает исполнителя'
+                         AND busy.id IS NULL
+                       """, (ph_id, ph_id, order_id))
+        claimed = cursor.rowcount == 1
+
+        cursor.execute("""
+                       SELECT o.status, o.description, o.expert_id, up.name
+                       FROM orders o
+                                LEFT JOIN users_ph up ON up.id = %s
+                       WHERE o.id = %s
+                       """, (ph_id, order_id))
+        order_data = cursor.fetchone()
+
+        if not claimed:
+            connection.rollback()
+            if not order_data:
+                return "missing", None
+            status = order_data[0]
+            if status == "Отменено":
+                return "cancelled", None
+            if status == "Ожидает исполнителя":
+                return "busy", None
+            return "taken", None
+
+        connection.commit()
+        _, description, expert_id, ph_name = order_data
+
+        cursor.execute(
+            "SELECT up.tg_id, om.message_id FROM order_messages om JOIN users_ph up ON up.id = om.ph_id WHERE om.order_id = %s",
+            (order_id,))
+        all_messages = cursor.fetchall()
+    return "ok", (description, expert_id, ph_name, all_messages)
+
+
 @ph_router.callback_query(lambda c: c.data.startswith("take_order_"))
 async def take_order(callback: types.CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[-1])  # type: ignore
@@ -664,76 +1919,28 @@ async def take_order(callback: types.CallbackQuery, state: FSMContext):
         return
 
     try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-
-        cursor2 = connection.cursor()
-        with connection.cursor() as cursor2:
-            cursor2.execute("""
-                            SELECT COUNT(*)
-                            FROM orders
-                            WHERE ph_id = %s
-                              AND status = 'В работе'
-                            """, (ph_id,))
-            if cursor2.fetchone()[0] > 0:  # type: ignore
-                await callback.answer("У вас уже есть заявка в работе!", show_alert=True)
-                return
+        result, order_data = await run_db(db_take_order, order_id, ph_id)
 
-        cursor3 = connection.cursor()
-        cursor3.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
-        status = cursor3.fetchone()[0]
+        if result in ("ok", "busy"):
+            performer_availability.mark_busy(ph_id)
+        if result != "busy":
+            order_dispatcher.close(order_id)
 
-        if status == "Отменено":
+        if result == "busy":
+            await callback.answer("У вас уже есть заявка в работе!", show_alert=True)
+            return
+        if result == "cancelled":
             await callback.answer("⚠️ Заявка была отменена экспертом!", show_alert=True)
             return
-
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT status, description, expert_id FROM orders WHERE id = %s",
-            (order_id,)
-        )
-        order_data = cursor.fetchone()
-        if not order_data:
+        if result == "missing":
             await callback.answer("⚠️ Заявка не найдена!")
             return
-
-        status, description, expert_id = order_data
-
-        if status != "Ожидает исполнителя":
+        if result == "taken":
             await callback.answer("⚠️ Заявка уже взята в работу!", show_alert=True)
             return
 
-        cursor.execute(
-            """UPDATE orders
-               SET status = 'В работе',
-                   ph_id  = %s
-               WHERE id = %s""",
-            (ph_id, order_id)
-        )
-
-        cursor.execute(
-            "SELECT up.tg_id, om.message_id FROM users_ph up LEFT JOIN order_messages om ON om.ph_id = up.id WHERE om.order_id = %s",
-            (order_id))
-        all_messages = cursor.fetchall()
-        print(all_messages)
-
-        cursor.execute(
-            "SELECT up.name FROM orders o INNER JOIN users_ph up on up.id = o.ph_id WHERE o.id = %s", (order_id))
-        ph_name = cursor.fetchone()[0]
-
-        for target_ph_id, message_id in all_messages:
-            try:
-                new_text = format_order_card(order_id, expert_id, description, f"В работе у {ph_name}")
-
-                await bot.edit_message_text(
-                    chat_id=target_ph_id,
-                    message_id=message_id,
-                    text=new_text,
-                    reply_markup=None
-                )
-            except Exception as e:
-                logging.error(f"Ошибка обновления сообщения {message_id}: {e}")
-
-        connection.commit()
+        description, expert_id, ph_name, all_messages = order_data
+        invalidate_ph_statistics(ph_id)
 
         await state.set_state(CompleteOrderStates.result_photos)
         await state.update_data(
@@ -754,17 +1961,17 @@ async def take_order(callback: types.CallbackQuery, state: FSMContext):
 
         await callback.answer("✅ Заявка взята в работу!", show_alert=True)
 
+        await card_updater.update(
+            all_messages, format_order_card(order_id, expert_id, description, f"В работе у {ph_name}")
+        )
+
     except Exception as e:
         logging.error(f"Ошибка: {e}")
         await callback.answer("❌ Ошибка!")
-    finally:
-        cursor2.close()
-        cursor.close()
-        connection.close()
 
 
 @ph_router.message(CompleteOrderStates.result_photos, F.photo)
-async def process_result_photos(message: types.Message, state: FSMContext):
+async def process_result_photos(message: types.Message, state: FSMContext, album=None):
     user_data = await state.get_data()
 
     ph_id = await get_ph_id(message.from_user.id)  # type: ignore
@@ -778,292 +1985,1110 @@ async def process_result_photos(message: types.Message, state: FSMContext):
         await message.answer("⚠️ Максимум 3 фото! Нажмите 'Завершить отправку фото'")
         return
 
-    photos.append(message.photo[-1].file_id)  # type: ignore
+    new_photos = album_file_ids(message, album)
+    skipped = max(0, len(photos) + len(new_photos) - 3)
+    photos.extend(new_photos[:len(new_photos) - skipped])
     await state.update_data(photos=photos)
 
     if len(photos) < 3:
         await message.answer(f"✅ Фото {len(photos)}/3 принято. Отправьте еще или нажмите кнопку завершения.")
     else:
-        await message.answer("✅ Принято 3 фото. Нажмите 'Завершить отправку фото' для завершения заявки.")
+        await message.answer("✅ Принято 3 фото. Нажмите 'Завершить отправку фото' для завершения заявки."
+                             + (f" Лишние фото ({skipped}) не приняты." if skipped else ""))
 
 
-@ph_router.message(CompleteOrderStates.result_photos, F.text == "Завершить отправку фото")
-async def finish_photos_upload(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
-    photos = user_data.get('photos', [])
+def db_lock_order_status(cursor, order_id):
+    """Статус заявки с блокировкой строки до конца транзакции."""
+    cursor.execute("SELECT status FROM orders WHERE id = %s FOR UPDATE", (order_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
-    if not photos:
-        await message.answer("❌ Нужно отправить хотя бы одно фото!")
-        return
 
-    order_id = user_data['order_id']
-    expert_id = user_data['expert_id']
-    ph_id = user_data['ph_id']
-    photo_count = len(photos)
+def db_rollup_order(cursor, order_id, sign):
+    """
+    Добавляет (sign=1) или вычитает (sign=-1) завершённую заявку в report_daily_rollup.
+    Вызывается в той же транзакции, что и смена статуса на 'Завершено' или с него.
+    """
+    cursor.execute(
+        """
+        INSERT INTO report_daily_rollup (day, expert_id, ph_id, orders_count, photos_sum)
+        SELECT DATE(created_at), expert_id, ph_id, %s, %s * COALESCE(result_photo, 0)
+        FROM orders
+        WHERE id = %s
+        ON DUPLICATE KEY UPDATE orders_count = orders_count + VALUES(orders_count),
+                                photos_sum   = photos_sum + VALUES(photos_sum)
+        """,
+        (sign, sign, order_id)
+    )
 
-    try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
 
+def db_rebuild_rollup(connection):
+    """Пересчитывает report_daily_rollup по orders целиком; возвращает число строк."""
+    with connection.cursor() as cursor:
+        connection.begin()
+        cursor.execute("DELETE FROM report_daily_rollup")
         cursor.execute(
-            "UPDATE orders SET status = 'Завершено', result_photo = %s WHERE id = %s",
-            (photo_count, order_id)
+            """
+            INSERT INTO report_daily_rollup (day, expert_id, ph_id, orders_count, photos_sum)
+            SELECT DATE(created_at), expert_id, ph_id, COUNT(*), COALESCE(SUM(result_photo), 0)
+            FROM orders
+            WHERE status = 'Завершено'
+            GROUP BY DATE(created_at), expert_id, ph_id
+            """
         )
+        rows = cursor.rowcount
+        connection.commit()
+    return rows
+
+
+def completion_outbox(order_id, expert_tg_id, photos):
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="Отправить на доработку?", callback_data='yes')
+    )
+    caption = f"Результат по заявке #{order_id}"
+    return [
+        outbox_media_group(expert_tg_id, photos, caption),
+        outbox_message(expert_tg_id, f"Отправить на доработку? #{order_id}", builder.as_markup()),
+        *(outbox_media_group(admin_id, photos, caption, priority="admin_copy") for admin_id in ADMIN_CHAT_IDS),
+    ]
+
+
+def db_complete_order(connection, order_id, expert_id, ph_id, photos, outbox_key):
+    """Сдаёт результат по заявке «В работе» у ph_id; None — заявка уже не у него в работе."""
+    with connection.cursor() as cursor:
+        connection.begin()
+        cursor.execute(
+            "UPDATE orders SET status = 'Завершено', result_photo = %s, completed_at = COALESCE(completed_at, NOW()) "
+            "WHERE id = %s AND status = 'В работе' AND ph_id = %s",
+            (len(photos), order_id, ph_id)
+        )
+        if cursor.rowcount != 1:
+            connection.rollback()
+            return None
+        db_rollup_order(cursor, order_id, 1)
 
         cursor.execute(
             "SELECT up.tg_id, om.message_id FROM users_ph up LEFT JOIN order_messages om ON om.ph_id = up.id WHERE om.order_id = %s",
-            (order_id))
+            (order_id,))
         all_messages = cursor.fetchall()
         cursor.execute("SELECT description FROM orders WHERE id = %s", (order_id,))
         description = cursor.fetchone()[0]  # type: ignore
 
-        for target_ph_id, message_id in all_messages:
-            try:
-                new_text = format_order_card(order_id, expert_id, description, "Выполнена")
-                await bot.edit_message_text(
-                    chat_id=target_ph_id,
-                    message_id=message_id,
-                    text=new_text,
-                    reply_markup=None
-                )
-            except Exception as e:
-                logging.error(f"Ошибка обновления сообщения {message_id}: {e}")
-
         cursor.execute("SELECT tg_id FROM users_expert WHERE id = %s", (expert_id,))
         expert_tg_id = cursor.fetchone()[0]  # type: ignore
 
-        media = [types.InputMediaPhoto(media=photo) for photo in photos]
+        db_enqueue_outbox(cursor, outbox_key, completion_outbox(order_id, expert_tg_id, photos))
+        connection.commit()
+    return description, all_messages
 
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text="Отправить на доработку?", callback_data='yes')
-        )
 
-        if media:
-            media[0].caption = f"Результат по заявке #{order_id}"
-            await bot.send_media_group(
-                chat_id=expert_tg_id,
-                media=media
-            )
-            await bot.send_message(
-                chat_id=expert_tg_id,
-                text=f"Отправить на доработку? #{order_id}",
-                reply_markup=builder.as_markup()
-            )
-            await bot.send_media_group(chat_id=ADMIN_ID_1, media=media)
-            await bot.send_media_group(chat_id=ADMIN_ID_2, media=media)
+@ph_router.message(CompleteOrderStates.result_photos, F.text == "Завершить отправку фото")
+async def finish_photos_upload(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
+    photos = user_data.get('photos', [])
+
+    if not photos:
+        await message.answer("❌ Нужно отправить хотя бы одно фото!")
+        return
+
+    order_id = user_data['order_id']
+    expert_id = user_data['expert_id']
+    ph_id = user_data['ph_id']
+
+    try:
+        completed = await run_db(
+            db_complete_order, order_id, expert_id, ph_id, photos, f"complete:{order_id}:{message.message_id}"
+        )
+        if completed is None:
+            await message.answer("⚠️ Заявка уже не у вас в работе: её отклонили или отменили",
+                                 reply_markup=ReplyKeyboardRemove())
+            return
+        description, all_messages = completed
+        outbox.wake()
+        invalidate_ph_statistics(ph_id)
+        performer_availability.mark_idle(ph_id)
 
         await message.answer("✅ Результат успешно отправлен эксперту!", reply_markup=ReplyKeyboardRemove())
-        connection.commit()
+
+        await card_updater.update(all_messages, format_order_card(order_id, expert_id, description, "Выполнена"))
+
+        await order_dispatcher.performer_released(ph_id)
 
     except Exception as e:
         logging.error(f"Ошибка: {e}")
         await message.answer("❌ Произошла ошибка при обработке")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
 
-async def send_order_to_ph(order_id, expert_id, description, photos):
-    try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-        cursor = connection.cursor()
+def db_insert_order_messages(connection, order_id, rows):
+    """
+    rows: [(order_id, ph_id, message_id)]; pymysql собирает их в один multi-row INSERT.
+    Возвращает (статус заявки, имя исполнителя) уже после вставки.
+    """
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO order_messages (order_id, ph_id, message_id) VALUES (%s, %s, %s)",
+            rows
+        )
+        connection.commit()
+        cursor.execute(
+            "SELECT o.status, up.name FROM orders o LEFT JOIN users_ph up ON up.id = o.ph_id WHERE o.id = %s",
+            (order_id,)
+        )
+        return cursor.fetchone()
 
-        cursor.execute("SELECT id, tg_id FROM users_ph")
-        performers = cursor.fetchall()
 
-        for ph_id, tg_id in performers:
-            try:
-                message_text = (
-                    f"📄 Новая заявка #{order_id}\n"
-                    f"👤 Создатель: #клиент{expert_id}\n"
-                    f"Описание: {description}\n"
-                    f"Статус: Ожидает исполнителя"
-                )
-                markup = InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="Взять в работу", callback_data=f"take_order_{order_id}"),
-                    InlineKeyboardButton(text="Отказать", callback_data=f"retake_order_{order_id}")
-                ]])
+def late_card_status_line(status, ph_name):
+    if status == "В работе":
+        return f"В работе у {ph_name}"
+    if status == "Отменено":
+        return "Отменена"
+    return "Выполнена"
 
-                msg = await bot.send_message(tg_id, message_text, reply_markup=markup)
 
-                for photo_id in photos:
-                    await bot.send_photo(tg_id, photo=photo_id)
+async def send_order_to_ph(order_id, expert_id, description, photos, performers, skip_button=False):
+    """
+    Рассылает карточку заявки исполнителям performers: [(ph_id, tg_id)].
+    skip_button добавляет кнопку «Пропустить» (режим назначения).
 
-                cursor.execute(
-                    "INSERT INTO order_messages (order_id, ph_id, message_id) VALUES (%s, %s, %s)",
-                    (order_id, ph_id, msg.message_id)
+    Сначала карточки уходят всем параллельно (чтобы никто не получил заявку
+    на несколько секунд раньше других), затем каждому — один альбом
+    с фотографиями ответом на его карточку.
+    Возвращает список DeliveryResult по карточкам.
+    """
+    message_text = (
+        f"📄 Новая заявка #{order_id}\n"
+        f"👤 Создатель: #клиент{expert_id}\n"
+        f"Описание: {description}\n"
+        f"Статус: Ожидает исполнителя"
+    )
+    buttons = [[
+        InlineKeyboardButton(text="Взять в работу", callback_data=f"take_order_{order_id}"),
+        InlineKeyboardButton(text="Отказать", callback_data=f"retake_order_{order_id}")
+    ]]
+    if skip_button:
+        buttons.append([InlineKeyboardButton(text="Пропустить", callback_data=f"skip_order_{order_id}")])
+    markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    async def deliver_card(performer):
+        ph_id, tg_id = performer
+        msg = await broadcaster.call(tg_id, lambda: bot.send_message(tg_id, message_text, reply_markup=markup))
+        return msg.message_id
+
+    async def deliver_photos(delivery):
+        (ph_id, tg_id), card_message_id = delivery
+        reply_to = ReplyParameters(message_id=card_message_id, allow_sending_without_reply=True)
+        if len(photos) == 1:
+            await broadcaster.call(tg_id, lambda: bot.send_photo(tg_id, photo=photos[0], reply_parameters=reply_to))
+        else:
+            media = [types.InputMediaPhoto(media=photo_id) for photo_id in photos]
+            await broadcaster.call(tg_id, lambda: bot.send_media_group(tg_id, media=media, reply_parameters=reply_to))
+
+    results = await broadcaster.broadcast(performers, deliver_card)
+    delivered = [(result.recipient, result.value) for result in results if result.ok]
+    for result in results:
+        if not result.ok:
+            logging.error(f"Ошибка отправки исполнителю {result.recipient[0]}: {result.error}")
+
+    still_waiting = True
+    if delivered:
+        try:
+            status, ph_name = await run_db(
+                db_insert_order_messages,
+                order_id,
+                [(order_id, ph_id, message_id) for (ph_id, _), message_id in delivered]
+            )
+            still_waiting = status == "Ожидает исполнителя"
+            if not still_waiting:
+                # Заявку взяли (или отменили), пока шли карточки: правка при взятии видела
+                # только уже сохранённые сообщения, поэтому эти карточки гасим сами.
+                await card_updater.update(
+                    [(tg_id, message_id) for (_, tg_id), message_id in delivered],
+                    format_order_card(order_id, expert_id, description, late_card_status_line(status, ph_name))
                 )
-                connection.commit()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения сообщений заявки #{order_id}: {e}")
+
+    if photos and still_waiting:
+        for result in await broadcaster.broadcast(delivered, deliver_photos):
+            if not result.ok:
+                logging.error(f"Ошибка отправки фото исполнителю {result.recipient[0][0]}: {result.error}")
+
+    logging.info(f"Заявка #{order_id}: карточка доставлена {len(delivered)}/{len(performers)} исполнителям")
+    return results
+
+
+def db_fetch_performer_availability(connection, with_speed=False):
+    """
+    (ph_id, tg_id, заявок «В работе», всего незакрытых заявок, среднее время
+    от взятия до сдачи в секундах) по всем исполнителям. Среднее время
+    считается только при with_speed (проход по всей истории заявок), иначе NULL.
+    """
+    speed = """
+            SELECT ph_id, AVG(TIMESTAMPDIFF(SECOND, taken_at, completed_at)) AS seconds
+            FROM orders
+            WHERE taken_at IS NOT NULL
+              AND completed_at IS NOT NULL
+            GROUP BY ph_id
+    """ if with_speed else "SELECT NULL AS ph_id, NULL AS seconds"
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+                       SELECT up.id,
+                              up.tg_id,
+                              COUNT(CASE WHEN o.status = 'В работе' THEN 1 END),
+                              COUNT(o.id),
+                              speed.seconds
+                       FROM users_ph up
+                                LEFT JOIN orders o
+                                          ON o.ph_id = up.id
+                                              AND o.status IN ('В работе', 'На доработке', 'Ожидает проверки')
+                                LEFT JOIN ({speed}) speed ON speed.ph_id = up.id
+                       GROUP BY up.id, up.tg_id, speed.seconds
+                       """)
+        return cursor.fetchall()
+
+
+def db_fetch_waiting_orders(connection, max_age_hours):
+    """
+    Заявки не старше max_age_hours, ждущие исполнителя, для восстановления рассылки после рестарта:
+    [(order_id, expert_id, description, created_at, photos, ph_id уже получивших карточку)].
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, expert_id, description, created_at FROM orders "
+            "WHERE status = 'Ожидает исполнителя' AND created_at >= NOW() - INTERVAL %s HOUR",
+            (max_age_hours,)
+        )
+        orders = cursor.fetchall()
+        if not orders:
+            return []
+        order_ids = [row[0] for row in orders]
+        placeholders = ", ".join(["%s"] * len(order_ids))
+        cursor.execute(f"SELECT order_id, photo_url FROM order_photos WHERE order_id IN ({placeholders})", order_ids)
+        photos = {}
+        for order_id, photo in cursor.fetchall():
+            photos.setdefault(order_id, []).append(photo)
+        cursor.execute(f"SELECT order_id, ph_id FROM order_messages WHERE order_id IN ({placeholders})", order_ids)
+        contacted = {}
+        for order_id, ph_id in cursor.fetchall():
+            contacted.setdefault(order_id, set()).add(ph_id)
+    return [(order_id, expert_id, description, created_at, photos.get(order_id, []), contacted.get(order_id, set()))
+            for order_id, expert_id, description, created_at in orders]
+
+
+def db_fetch_waiting_order_ids(connection, order_ids):
+    """Какие из order_ids всё ещё ждут исполнителя."""
+    placeholders = ", ".join(["%s"] * len(order_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM orders WHERE id IN ({placeholders}) AND status = 'Ожидает исполнителя'",
+            list(order_ids)
+        )
+        return {row[0] for row in cursor.fetchall()}
+
 
+class PerformerAvailability:
+    """Кэш исполнителей: кто свободен и сколько у кого незакрытых заявок."""
+
+    def __init__(self, refresh_interval, with_speed=False):
+        self._refresh_interval = refresh_interval
+        self._with_speed = with_speed
+        self._tg_ids = {}  # ph_id -> tg_id
+        self._load = {}  # ph_id -> незакрытых заявок
+        self._speed = {}  # ph_id -> среднее время выполнения, с
+        self._busy = set()
+        self._offered_at = {}  # ph_id -> когда последний раз предлагалась заявка
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self._refresh_interval
+
+    async def refresh_if_stale(self) -> None:
+        if self._fresh():
+            return
+        async with self._lock:
+            if self._fresh():
+                return
+            rows = await run_db(db_fetch_performer_availability, self._with_speed)
+            self._tg_ids = {ph_id: tg_id for ph_id, tg_id, *_ in rows}
+            self._busy = {ph_id for ph_id, _, in_work, *_ in rows if in_work}
+            self._load = {ph_id: load for ph_id, _, _, load, _ in rows}
+            self._speed = {ph_id: float(seconds) for ph_id, *_, seconds in rows if seconds is not None}
+            self._loaded_at = time.monotonic()
+            self.refreshes += 1
+
+    def mark_busy(self, ph_id) -> None:
+        if ph_id not in self._busy:
+            self._busy.add(ph_id)
+            self._load[ph_id] = self._load.get(ph_id, 0) + 1
+
+    def mark_idle(self, ph_id) -> None:
+        if ph_id in self._busy:
+            self._busy.discard(ph_id)
+            self._load[ph_id] = max(0, self._load.get(ph_id, 0) - 1)
+
+    def tg_id(self, ph_id):
+        return self._tg_ids.get(ph_id)
+
+    def completion_time(self, ph_id):
+        """Среднее время от взятия до сдачи, с; None — истории ещё нет."""
+        return self._speed.get(ph_id)
+
+    def offered(self, ph_ids) -> None:
+        now = time.monotonic()
+        for ph_id in ph_ids:
+            self._offered_at[ph_id] = now
+
+    def idle(self, exclude=()):
+        """Свободные исполнители [(ph_id, tg_id)]: сначала наименее загруженные, при равенстве — кому дольше не предлагали."""
+        candidates = [ph_id for ph_id in self._tg_ids if ph_id not in self._busy and ph_id not in exclude]
+        candidates.sort(key=lambda ph_id: (self._load.get(ph_id, 0), self._offered_at.get(ph_id, 0.0)))
+        return [(ph_id, self._tg_ids[ph_id]) for ph_id in candidates]
+
+    def stats(self) -> dict:
+        return {
+            "performers": len(self._tg_ids),
+            "busy": len(self._busy),
+            "refreshed_ago": round(time.monotonic() - self._loaded_at) if self._loaded_at is not None else None,
+        }
+
+
+class OrderOffer:
+    __slots__ = ("order_id", "expert_id", "description", "photos", "contacted", "created_at", "next_wave_at",
+                 "holder", "holder_card", "broadcast")
+
+    def __init__(self, order_id, expert_id, description, photos, contacted=(), created_at=None):
+        self.order_id = order_id
+        self.expert_id = expert_id
+        self.description = description
+        self.photos = photos
+        self.contacted = set(contacted)
+        self.created_at = created_at or datetime.now()
+        self.next_wave_at = 0.0
+        self.holder = None  # ph_id, которому заявка предложена сейчас (режим назначения)
+        self.holder_card = None  # (tg_id, message_id) его карточки
+        self.broadcast = False
+
+
+class OrderDispatcher:
+    """Рассылка новых заявок свободным исполнителям волнами или по одному (mode="assign")."""
+
+    def __init__(self, availability, wave_size, wave_interval, mode="broadcast",
+                 strategy="least_loaded", accept_timeout=120, max_age_hours=24):
+        self._availability = availability
+        self._max_age = timedelta(hours=max_age_hours)
+        self._wave_size = wave_size
+        self._wave_interval = wave_interval
+        self._mode = mode
+        self._strategy = strategy
+        self._accept_timeout = accept_timeout
+        self._offers = {}  # order_id -> OrderOffer
+        self._reserved = {}  # ph_id -> order_id, предложенная ему сейчас
+        self._round_robin_last = None
+        self._assign_lock = asyncio.Lock()  # смена держателя заявки: таймаут, «Пропустить», освобождение
+        self._task = None
+        self.waves = 0
+        self.cards = 0
+        self.assigned = 0
+        self.expired = 0
+        self.fallbacks = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def restore(self) -> None:
+        rows = await run_db(db_fetch_waiting_orders, int(self._max_age.total_seconds() // 3600))
+        for order_id, expert_id, description, created_at, photos, contacted in rows:
+            self._offers[order_id] = OrderOffer(order_id, expert_id, description, photos, contacted, created_at)
+        if self._offers:
+            logging.info(f"Восстановлена рассылка {len(self._offers)} ждущих заявок")
+
+    async def dispatch(self, order_id, expert_id, description, photos) -> None:
+        offer = OrderOffer(order_id, expert_id, description, photos)
+        self._offers[order_id] = offer
+        try:
+            await self._send_wave(offer)
+        except Exception as e:
+            # Заявка остаётся в очереди: фоновый цикл повторит рассылку.
+            logging.error(f"Ошибка рассылки заявки #{order_id}: {e}")
+
+    def close(self, order_id) -> None:
+        """Заявку взяли, отменили или отклонили — больше её не рассылать."""
+        offer = self._offers.pop(order_id, None)
+        if offer is not None and offer.holder is not None:
+            self._reserved.pop(offer.holder, None)
+
+    async def skip(self, order_id, ph_id) -> bool:
+        """Исполнитель пропустил предложенную ему заявку — она сразу уходит следующему."""
+        async with self._assign_lock:
+            offer = self._offers.get(order_id)
+            if offer is None or offer.holder != ph_id:
+                return False
+            await self._assign_next(offer, f"⏭ Заявка #{order_id} пропущена и передана другому исполнителю")
+            return True
+
+    async def performer_released(self, ph_id) -> None:
+        self._availability.mark_idle(ph_id)
+        tg_id = self._availability.tg_id(ph_id)
+        stale_before = datetime.now() - self._max_age
+        for offer in list(self._offers.values()):
+            if offer.created_at < stale_before:
+                continue
+            if self._assigning(offer):
+                async with self._assign_lock:
+                    if offer.order_id in self._offers and offer.holder is None:
+                        await self._assign_next(offer)
+            elif tg_id is not None and ph_id not in offer.contacted:
+                await self._offer(offer, [(ph_id, tg_id)])
+
+    def _assigning(self, offer):
+        return self._mode == "assign" and not offer.broadcast
+
+    def _pick(self, candidates):
+        if self._strategy == "round_robin":
+            candidates = sorted(candidates)
+            after = [candidate for candidate in candidates
+                     if self._round_robin_last is not None and candidate[0] > self._round_robin_last]
+            chosen = (after or candidates)[0]
+            self._round_robin_last = chosen[0]
+            return chosen
+        if self._strategy == "fastest":
+            # Без истории — после исполнителей с известным временем; min устойчив к порядку idle().
+            return min(candidates, key=lambda candidate: (
+                self._availability.completion_time(candidate[0]) is None,
+                self._availability.completion_time(candidate[0]) or 0.0,
+            ))
+        return candidates[0]  # least_loaded: idle() уже упорядочен по загрузке
+
+    async def _release_holder(self, offer, notice):
+        if offer.holder is None:
+            return
+        self._reserved.pop(offer.holder, None)
+        card, offer.holder, offer.holder_card = offer.holder_card, None, None
+        if card is not None:
+            await card_updater.update([card], notice)
+
+    async def _assign_next(self, offer, notice=None):
+        """Передаёт заявку следующему исполнителю; вызывается под _assign_lock."""
+        if offer.holder is not None and notice is None:
+            self.expired += 1
+        await self._release_holder(
+            offer, notice or f"⌛ Время на ответ по заявке #{offer.order_id} истекло, она передана другому исполнителю"
+        )
+        offer.next_wave_at = 0.0
+        while True:
+            idle = self._availability.idle()
+            untried = [performer for performer in idle
+                       if performer[0] not in offer.contacted and performer[0] not in self._reserved]
+            if untried:
+                ph_id, tg_id = self._pick(untried)
+                results = await self._offer(offer, [(ph_id, tg_id)], skip_button=True)
+                if not results or not results[0].ok:
+                    continue  # не доставилось (например, бот заблокирован) — следующему
+                if offer.order_id not in self._offers:
+                    return  # заявку взяли или отменили, пока шла отправка
+                offer.holder, offer.holder_card = ph_id, (tg_id, results[0].value)
+                self._reserved[ph_id] = offer.order_id
+                offer.next_wave_at = time.monotonic() + self._accept_timeout
+                self.assigned += 1
+                return
+            if idle and all(ph_id in offer.contacted for ph_id, _ in idle):
+                # Все свободные заявку уже видели — рассылаем им разом, дальше как в режиме broadcast.
+                performers = [performer for performer in idle if performer[0] not in self._reserved]
+                if performers:
+                    offer.broadcast = True
+                    offer.next_wave_at = time.monotonic() + self._wave_interval
+                    self.fallbacks += 1
+                    await self._offer(offer, performers)
+            # Свободных нет — ждём, пока кто-нибудь освободится (performer_released) или следующего тика.
+            return
+
+    async def _send_wave(self, offer):
+        await self._availability.refresh_if_stale()
+        if self._assigning(offer):
+            async with self._assign_lock:
+                if offer.order_id in self._offers and offer.next_wave_at <= time.monotonic():
+                    await self._assign_next(offer)
+            return
+        performers = self._availability.idle(exclude=offer.contacted)
+        if self._wave_size:
+            performers = performers[:self._wave_size]
+        offer.next_wave_at = time.monotonic() + self._wave_interval
+        if performers:
+            self.waves += 1
+            await self._offer(offer, performers)
+
+    async def _offer(self, offer, performers, skip_button=False):
+        offer.contacted.update(ph_id for ph_id, _ in performers)
+        self._availability.offered(ph_id for ph_id, _ in performers)
+        results = await send_order_to_ph(
+            offer.order_id, offer.expert_id, offer.description, offer.photos, performers, skip_button
+        )
+        self.cards += sum(1 for result in results if result.ok)
+        return results
+
+    async def _loop(self):
+        tick = min(self._wave_interval, self._accept_timeout, 10) if self._mode == "assign" \
+            else min(self._wave_interval, 10)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                await self._widen()
             except Exception as e:
-                logging.error(f"Ошибка отправки исполнителю {ph_id}: {e}")
+                logging.error(f"Ошибка рассылки ждущих заявок: {e}", exc_info=True)
 
-    except Exception as e:
-        logging.error(f"Ошибка рассылки заявок: {e}")
+    async def _widen(self):
+        if not self._offers:
+            return
+        waiting = await run_db(db_fetch_waiting_order_ids, list(self._offers))
+        stale_before = datetime.now() - self._max_age
+        for order_id, offer in list(self._offers.items()):
+            # Брошенные заявки старше max_age больше не предлагаются новым исполнителям.
+            if order_id not in waiting or offer.created_at < stale_before:
+                self.close(order_id)
+        now = time.monotonic()
+        for offer in list(self._offers.values()):
+            if offer.next_wave_at <= now:
+                await self._send_wave(offer)
+
+    def stats(self) -> dict:
+        stats = {"mode": self._mode, "waiting": len(self._offers), "waves": self.waves, "cards": self.cards}
+        if self._mode == "assign":
+            stats.update(strategy=self._strategy, offered=len(self._reserved), assigned=self.assigned,
+                         expired=self.expired, fallbacks=self.fallbacks)
+        return {**stats, **self._availability.stats()}
+
+
+performer_availability = PerformerAvailability(
+    PERFORMERS_REFRESH, with_speed=DISPATCH_MODE == "assign" and ASSIGN_STRATEGY == "fastest"
+)
+order_dispatcher = OrderDispatcher(
+    performer_availability, DISPATCH_WAVE_SIZE, DISPATCH_WAVE_INTERVAL,
+    mode=DISPATCH_MODE, strategy=ASSIGN_STRATEGY, accept_timeout=ASSIGN_ACCEPT_TIMEOUT,
+    max_age_hours=DISPATCH_MAX_AGE_HOURS
+)
+
+
+def run_report_job(func, *args):
+    """
+    Выполняется в процессе-воркере: у процесса нет доступа к db_pool,
+    поэтому на задачу открывается своё соединение.
+    """
+    connection = pymysql.connect(**DB_CONFIG)
+    try:
+        return func(connection, *args)
     finally:
-        cursor.close()
         connection.close()
 
 
+def db_report_watermark(connection):
+    """Отметка актуальности данных: новые заявки меняют MAX(id), смена статуса — MAX(updated_at)."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(id), MAX(updated_at) FROM orders")
+        return tuple(cursor.fetchone())
+
+
+class ReportJobs:
+    """Фоновые задачи отчётов в пуле процессов с кэшем готовых файлов по watermark."""
+
+    def __init__(self, bot, workers, cache):
+        self._bot = bot
+        self._workers = workers
+        self._cache = cache
+        self._executor = None
+        self._inflight = {}  # (key, watermark) -> asyncio.Future
+        self._tasks = set()
+        self.built = 0
+        self.failed = 0
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn, а не fork: в родителе уже работают потоки и открыты сокеты БД.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def build(self, key, func, *args):
+        """Возвращает ((file_name, content), from_cache)."""
+        watermark = await run_db(db_report_watermark)
+        cache_key = (key, watermark)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+
+        future = self._inflight.get(cache_key)
+        if future is None:
+            future = asyncio.ensure_future(self._execute(func, *args))
+            self._inflight[cache_key] = future
+            try:
+                result = await asyncio.shield(future)
+            finally:
+                self._inflight.pop(cache_key, None)
+            self._cache.set(cache_key, result)
+            return result, False
+        return await asyncio.shield(future), True
+
+    async def _execute(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._pool(), run_report_job, func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        self.built += 1
+        return result
+
+    def submit(self, chat_id, key, func, *args, caption, stream=False):
+        task = asyncio.create_task(self._run(chat_id, key, func, args, caption, stream))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, chat_id, key, func, args, caption, stream):
+        status = await self._bot.send_message(chat_id, "⏳ Отчет формируется…")
+        try:
+            if stream:
+                file_name, path = await self._execute(func, *args)
+                try:
+                    document = FSInputFile(path, filename=file_name)
+                    await self._bot.send_document(chat_id=chat_id, document=document, caption=caption)
+                finally:
+                    os.remove(path)
+                from_cache = False
+            else:
+                (file_name, content), from_cache = await self.build(key, func, *args)
+                await self._bot.send_document(
+                    chat_id=chat_id,
+                    document=types.BufferedInputFile(content, filename=file_name),
+                    caption=caption
+                )
+            await status.edit_text("✅ Отчет успешно сгенерирован и отправлен!" + (" (из кэша)" if from_cache else ""))
+        except Exception as e:
+            logging.error(f"Ошибка генерации отчета {key}: {e}")
+            await status.edit_text("❌ Ошибка при генерации отчета")
+
+    def stats(self) -> dict:
+        return {"running": len(self._inflight), "built": self.built, "failed": self.failed,
+                "cache": self._cache.stats()}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+report_cache = TTLCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL)
+report_jobs = ReportJobs(bot, REPORT_PROCESS_WORKERS, report_cache)
+
+
+def write_workbook(sheets):
+    """Пишет {имя листа: DataFrame} в xlsx в памяти и возвращает байты."""
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return buffer.getvalue()
+
+
+def report_file_name():
+    return f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+
+def rollup_by_month(daily_df, key_columns):
+    """
+    Сворачивает дневную статистику в месячную.
+
+    key_columns — атрибуты сущности (id, имя, ...); суммируются total_orders
+    и total_amount. Сумма считается по дневным суммам, поэтому совпадает
+    с прямой агрегацией по месяцу.
+    """
+    monthly = daily_df.assign(month=daily_df["DAY"].str[:7])
+    attributes = {column: (column, "first") for column in key_columns if column != "id"}
+    monthly = monthly.groupby(["id", "month"], as_index=False, sort=True).agg(
+        **attributes,
+        total_orders=("total_orders", "sum"),
+        total_amount=("total_amount", "sum"),
+    )
+    ordered = [c for c in daily_df.columns if c != "DAY"]
+    ordered.insert(ordered.index("total_orders"), "month")
+    return monthly[ordered]
+
+
+def parse_report_date(text, end=False):
+    """YYYY-MM-DD или YYYY-MM; для месяца берётся первый (или последний, если end) день."""
+    if re.fullmatch(r"\d{4}-\d{2}", text):
+        first = datetime.strptime(text, "%Y-%m").date()
+        if not end:
+            return first
+        next_month = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return next_month - timedelta(days=1)
+    return datetime.strptime(text, "%Y-%m-%d").date()
+
+
+def parse_report_period(args):
+    """
+    [from] [to] из аргументов команды -> (date_from, date_to), границы включительно.
+    Один аргумент задаёт период целиком: /rep 2024-05 — весь май.
+    Без аргументов — вся история (None, None).
+    """
+    if len(args) > 2:
+        raise ValueError("слишком много аргументов")
+    if not args:
+        return None, None
+    date_from = parse_report_date(args[0])
+    date_to = parse_report_date(args[-1], end=True)
+    if date_from > date_to:
+        raise ValueError("начало периода позже конца")
+    return date_from, date_to
+
+
+def report_period_label(date_from, date_to):
+    if date_from is None:
+        return "за всё время"
+    return f"за {date_from:%d.%m.%Y} – {date_to:%d.%m.%Y}"
+
+
+def rollup_period_filter(date_from, date_to):
+    """Условие по r.day (ведущая колонка PK report_daily_rollup) и его параметры."""
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append("r.day >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("r.day <= %s")
+        params.append(date_to)
+    return "".join(f" AND {condition}" for condition in conditions), params
+
+
+def build_general_report(connection, date_from=None, date_to=None):
+    """
+    Собирает общий Excel-отчёт; выполняется в процессе report_jobs.
+
+    Данные берутся из report_daily_rollup (строка на день × эксперт × исполнитель),
+    поэтому время отчёта зависит от числа дней в периоде, а не от числа заявок.
+    Месячные листы получаются из дневных в памяти.
+    """
+    period_sql, period_params = rollup_period_filter(date_from, date_to)
+    experts_daily_query = f"""
+                          SELECT ue.id,
+                                 ue.name,
+                                 ue.surname,
+                                 ue.adress_oto,
+                                 DATE_FORMAT(r.day, '%%Y-%%m-%%d') as DAY,
+                                 SUM(r.orders_count) as total_orders,
+                                 SUM(r.photos_sum * ph.order_price) as total_amount,
+                                 ue.tg_id as TelegramId
+                          FROM report_daily_rollup r
+                                   JOIN users_expert ue ON r.expert_id = ue.id
+                                   JOIN users_ph ph ON r.ph_id = ph.id
+                          WHERE r.orders_count > 0{period_sql}
+                          GROUP BY ue.id, r.day
+                          ORDER BY ue.id, r.day
+                          """
+    experts_daily = pd.read_sql(experts_daily_query, connection, params=period_params)  # type: ignore
+
+    ph_daily_query = f"""
+                     SELECT ph.id,
+                            ph.name,
+                            DATE_FORMAT(r.day, '%%Y-%%m-%%d') as DAY,
+                            SUM(r.orders_count) as total_orders,
+                            SUM(r.photos_sum * ph.order_price) as total_amount
+                     FROM report_daily_rollup r
+                              JOIN users_ph ph ON r.ph_id = ph.id
+                     WHERE r.orders_count > 0{period_sql}
+                     GROUP BY ph.id, r.day
+                     ORDER BY ph.id, r.day
+                     """
+    ph_daily = pd.read_sql(ph_daily_query, connection, params=period_params)  # type: ignore
+
+    content = write_workbook({
+        'Эксперты_по_мес': rollup_by_month(experts_daily, ["id", "name", "surname", "adress_oto", "TelegramId"]),
+        'Исполнители_по_мес': rollup_by_month(ph_daily, ["id", "name"]),
+        'Эксперты_по_дням': experts_daily,
+        'Исполнители_по_дням': ph_daily,
+    })
+    return report_file_name(), content
+
+
 @dp.message(Command("rep"))
 async def generate_report(message: types.Message):
-    # if message.from_user.id != ADMIN_ID_1 and message.from_user.id != ADMIN_ID_2:  # type: ignore
-    #     await message.answer("❌ Доступ запрещен!")
-    #     return
-    #     коммент до выяснения обстоятельств((
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен!")
+        return
 
-    file_name = None
+    argument = message.text.split()[1:]  # type: ignore
+    if argument == ["last"]:
+        await send_latest_scheduled_reports(message)
+        return
     try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-
-        experts_query = """
-                        SELECT ue.id, 
-                               ue.name, 
-                               ue.surname, 
-                               ue.adress_oto, 
-                               DATE_FORMAT(o.created_at, '%Y-%m') as month,
-                COUNT(o.id) as total_orders,
-                ph.order_price * SUM(o.result_photo) as total_amount,
-                ue.tg_id as TelegramId
-                        FROM orders o
-                            JOIN users_expert ue 
-                        ON o.expert_id = ue.id
-                            JOIN users_ph ph ON o.ph_id = ph.id
-                        WHERE o.status = 'Завершено'
-                        GROUP BY ue.id, month
-                        ORDER BY ue.id, month 
-                        """
-        experts_df = pd.read_sql(experts_query, connection)  # type: ignore
-
-        ph_query = """
-                   SELECT ph.id, 
-                          ph.name, 
-                          DATE_FORMAT(o.created_at, '%Y-%m') as month,
-                COUNT(o.id) as total_orders,
-                ph.order_price * SUM(o.result_photo) as total_amount
-                   FROM orders o
-                       JOIN users_ph ph 
-                   ON o.ph_id = ph.id
-                   WHERE o.status = 'Завершено'
-                   GROUP BY ph.id, month
-                   ORDER BY ph.id, month 
-                   """
-        ph_df = pd.read_sql(ph_query, connection)  # type: ignore
-
-        experts_query2 = """
-                         SELECT ue.id, 
-                                ue.name, 
-                                ue.surname, 
-                                ue.adress_oto, 
-                                DATE_FORMAT(o.created_at, '%Y-%m-%d') as DAY,
-                COUNT(o.id) as total_orders,
-                ph.order_price * SUM(o.result_photo) as total_amount,
-                ue.tg_id as TelegramId
-                         FROM orders o
-                             JOIN users_expert ue 
-                         ON o.expert_id = ue.id
-                             JOIN users_ph ph ON o.ph_id = ph.id
-                         WHERE o.status = 'Завершено'
-                         GROUP BY ue.id, DAY
-                         ORDER BY ue.id, DAY 
-                         """
-        experts_df2 = pd.read_sql(experts_query2, connection)  # type: ignore
-
-        ph_query2 = """
-                    SELECT ph.id, 
-                           ph.name, 
-                           DATE_FORMAT(o.created_at, '%Y-%m-%d') as DAY,
-                COUNT(o.id) as total_orders,
-                ph.order_price * SUM(o.result_photo) as total_amount
-                    FROM orders o
-                        JOIN users_ph ph 
-                    ON o.ph_id = ph.id
-                    WHERE o.status = 'Завершено'
-                    GROUP BY ph.id, DAY
-                    ORDER BY ph.id, DAY 
-                    """
-        ph_df2 = pd.read_sql(ph_query2, connection)  # type: ignore
-
-        file_name = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        with pd.ExcelWriter(file_name) as writer:
-            experts_df.to_excel(writer, sheet_name='Эксперты_по_мес', index=False)
-            ph_df.to_excel(writer, sheet_name='Исполнители_по_мес', index=False)
-            experts_df2.to_excel(writer, sheet_name='Эксперты_по_дням', index=False)
-            ph_df2.to_excel(writer, sheet_name='Исполнители_по_дням', index=False)
-
-        with open(file_name, "rb") as file:
-            await bot.send_document(
-                chat_id=message.chat.id,
-                document=types.BufferedInputFile(file.read(), filename=file_name),
-                caption="📊 Отчет по завершенным заявкам"
-            )
-
-        await message.answer("✅ Отчет успешно сгенерирован и отправлен!")
-
-    except Exception as e:
-        logging.error(f"Ошибка генерации отчета: {e}")
-        await message.answer("❌ Ошибка при генерации отчета")
-    finally:
-        if connection:
-            connection.close()
-        if file_name and os.path.exists(file_name):
-            os.remove(file_name)
+        date_from, date_to = parse_report_period(argument)
+    except ValueError:
+        await message.answer("Использование: /rep [с] [по] | /rep last, даты в формате ГГГГ-ММ-ДД или ГГГГ-ММ")
+        return
+    report_jobs.submit(message.chat.id, ("general", date_from, date_to), build_general_report, date_from, date_to,
+                       caption=f"📊 Отчет по завершенным заявкам {report_period_label(date_from, date_to)}")
+
+
+def expert_sheet_name(row):
+    """Имя листа Excel: не длиннее 31 символа и без []:*?/\\."""
+    title = " ".join(str(part) for part in (row["TelegramId"], row["surname"], row["name"]) if pd.notna(part) and str(part))
+    return re.sub(r"[\[\]:*?/\\]", "", title)[:31]
+
+
+def build_expert_report(connection, expert_tg_ids, date_from=None, date_to=None):
+    """
+    Собирает Excel-отчёт по экспертам (лист на эксперта) одним запросом;
+    выполняется в процессе report_jobs.
+    """
+    period_sql, period_params = rollup_period_filter(date_from, date_to)
+    placeholders = ", ".join(["%s"] * len(expert_tg_ids))
+    experts_query = f"""
+        SELECT 
+            ue.id,
+            ue.name,
+            ue.surname,
+            ue.adress_oto,
+            DATE_FORMAT(r.day, '%%Y-%%m') as month,
+            SUM(r.orders_count) as total_orders,
+            SUM(r.orders_count * ph.order_price) as total_amount,
+            ue.tg_id as TelegramId
+        FROM users_expert ue
+        JOIN report_daily_rollup r ON r.expert_id = ue.id
+        JOIN users_ph ph ON r.ph_id = ph.id
+        WHERE ue.tg_id IN ({placeholders})
+        AND r.orders_count > 0{period_sql}
+        GROUP BY ue.id, month
+        ORDER BY ue.id, month
+    """
+    experts_df = pd.read_sql(experts_query, connection, params=[*expert_tg_ids, *period_params])  # type: ignore
+
+    sheets = {}
+    for _, expert_df in experts_df.groupby("id", sort=False):
+        sheets[expert_sheet_name(expert_df.iloc[0])] = expert_df
+    if not sheets:
+        sheets['Эксперт'] = experts_df
+    return report_file_name(), write_workbook(sheets)
 
 
 @dp.message(Command("repexp"))
 async def generate_report2(message: types.Message):
-    if message.from_user.id != ADMIN_ID_1 and message.from_user.id != ADMIN_ID_2:  # type: ignore
+    if not is_admin(message.from_user.id):
         await message.answer("❌ Доступ запрещен!")
         return
 
     argument = message.text.split()[1:]  # type: ignore
-    file_name = None
     try:
-        connection = pymysql.connect(**DB_CONFIG)  # type: ignore
-
-        experts_query = f"""
-            SELECT 
-                ue.id,
-                ue.name,
-                ue.surname,
-                ue.adress_oto,
-                DATE_FORMAT(o.created_at, '%Y-%m') as month,
-                COUNT(o.id) as total_orders,
-                SUM(ph.order_price) as total_amount,
-                ue.tg_id as TelegramId
+        if not argument:
+            raise ValueError("не указан TG_ID")
+        expert_tg_ids = tuple(sorted({int(tg_id) for tg_id in argument[0].split(",") if tg_id}))
+        date_from, date_to = parse_report_period(argument[1:])
+    except ValueError:
+        await message.answer("Использование: /repexp <TG_ID>[,<TG_ID>...] [с] [по], даты в формате ГГГГ-ММ-ДД или ГГГГ-ММ")
+        return
+    report_jobs.submit(message.chat.id, ("expert", expert_tg_ids, date_from, date_to), build_expert_report,
+                       expert_tg_ids, date_from, date_to,
+                       caption=f"📊 Отчет по завершенным заявкам {report_period_label(date_from, date_to)}")
+
+
+EXPORT_FORMATS = ("xlsx", "csv", "csv.gz")
+EXPORT_COLUMNS = ["order_id", "created_at", "expert_tg_id", "expert_surname", "expert_name",
+                  "ph_id", "ph_name", "result_photo", "amount"]
+
+
+def iter_export_rows(connection, date_from, date_to):
+    """
+    Завершённые заявки построчно. SSCursor не буферизует результат на клиенте,
+    строки забираются пачками по EXPORT_CHUNK_SIZE — память не растёт с историей.
+    """
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append("o.created_at >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("o.created_at < %s")
+        params.append(date_to + timedelta(days=1))
+    period_sql = "".join(f" AND {condition}" for condition in conditions)
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(
+            f"""
+            SELECT o.id, o.created_at, ue.tg_id, ue.surname, ue.name,
+                   ph.id, ph.name, o.result_photo, o.result_photo * ph.order_price
             FROM orders o
-            JOIN users_expert ue ON o.expert_id = ue.id
-            JOIN users_ph ph ON o.ph_id = ph.id
-            WHERE o.status = 'Завершено'
-            AND ue.tg_id = '{argument[0]}'
-            GROUP BY ue.id, month
-            ORDER BY ue.id, month
-        """
-        experts_df = pd.read_sql(experts_query, connection)  # type: ignore
+                     JOIN users_expert ue ON o.expert_id = ue.id
+                     JOIN users_ph ph ON o.ph_id = ph.id
+            WHERE o.status = 'Завершено'{period_sql}
+            ORDER BY o.created_at, o.id
+            """,
+            params
+        )
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+
+def build_orders_export(connection, export_format, date_from=None, date_to=None):
+    """
+    Потоковая выгрузка заявок в xlsx (write-only), csv или csv.gz во временный файл;
+    выполняется в процессе report_jobs. Возвращает (file_name, path).
+    """
+    suffix = "." + export_format
+    fd, path = tempfile.mkstemp(prefix="phbot_export_", suffix=suffix)
+    os.close(fd)
+    rows = iter_export_rows(connection, date_from, date_to)
+    try:
+        if export_format == "xlsx":
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet = workbook.create_sheet("Заявки")
+            sheet.append(EXPORT_COLUMNS)
+            for row in rows:
+                sheet.append(row)
+            workbook.save(path)
+        else:
+            opener = gzip.open if export_format == "csv.gz" else open
+            with opener(path, "wt", encoding="utf-8-sig", newline="") as file:
+                writer = csv.writer(file, delimiter=";")
+                writer.writerow(EXPORT_COLUMNS)
+                for row in rows:
+                    writer.writerow(row)
+    except BaseException:
+        os.remove(path)
+        raise
+    return f"orders_{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}", path
+
+
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен!")
+        return
 
-        file_name = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        with pd.ExcelWriter(file_name) as writer:
-            experts_df.to_excel(writer, sheet_name='Эксперт', index=False)
+    argument = message.text.split()[1:]  # type: ignore
+    export_format = "xlsx"
+    if argument and argument[0] in EXPORT_FORMATS:
+        export_format = argument.pop(0)
+    try:
+        date_from, date_to = parse_report_period(argument)
+    except ValueError:
+        await message.answer("Использование: /export [xlsx|csv|csv.gz] [с] [по], даты в формате ГГГГ-ММ-ДД или ГГГГ-ММ")
+        return
+    report_jobs.submit(message.chat.id, ("export", export_format, date_from, date_to), build_orders_export,
+                       export_format, date_from, date_to,
+                       caption=f"📦 Выгрузка завершённых заявок {report_period_label(date_from, date_to)}",
+                       stream=True)
+
+
+def next_run_at(now, at, monthly):
+    """Ближайший момент HH:MM после now; для monthly — 1-го числа."""
+    hour, minute = (int(part) for part in at.split(":"))
+    candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if monthly:
+        candidate = candidate.replace(day=1)
+    if candidate > now:
+        return candidate
+    if monthly:
+        return (candidate.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return candidate + timedelta(days=1)
+
+
+def scheduled_report_period(kind, today):
+    """daily — вчерашний день, monthly — прошлый месяц."""
+    if kind == "daily":
+        yesterday = today - timedelta(days=1)
+        return yesterday, yesterday
+    last_day = today.replace(day=1) - timedelta(days=1)
+    return last_day.replace(day=1), last_day
+
+
+class ReportScheduler:
+    """Плановые отчёты за прошлый день / месяц с рассылкой админам."""
+
+    def __init__(self, jobs, recipients, schedules):
+        self._jobs = jobs
+        self._recipients = recipients
+        self._schedules = schedules  # [(kind, "HH:MM", monthly)]
+        self._tasks = []
+        self.latest = {}  # kind -> (file_name, content, caption)
+
+    def start(self) -> None:
+        for kind, at, monthly in self._schedules:
+            if at:
+                self._tasks.append(asyncio.create_task(self._loop(kind, at, monthly)))
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def _loop(self, kind, at, monthly):
+        while True:
+            now = datetime.now()
+            run_at = next_run_at(now, at, monthly)
+            logging.info(f"Плановый отчёт {kind}: следующий запуск {run_at:%Y-%m-%d %H:%M}")
+            await asyncio.sleep((run_at - now).total_seconds())
+            try:
+                await self.run(kind)
+            except Exception as e:
+                logging.error(f"Ошибка планового отчёта {kind}: {e}", exc_info=True)
+
+    async def run(self, kind):
+        date_from, date_to = scheduled_report_period(kind, date.today())
+        (file_name, content), _ = await self._jobs.build(
+            ("general", date_from, date_to), build_general_report, date_from, date_to)
+        caption = f"📊 Плановый отчет {report_period_label(date_from, date_to)}"
+        self.latest[kind] = (file_name, content, caption)
+
+        async def deliver(chat_id):
+            await broadcaster.call(chat_id, lambda: bot.send_document(
+                chat_id=chat_id,
+                document=types.BufferedInputFile(content, filename=file_name),
+                caption=caption
+            ), priority="admin_copy")
+
+        for result in await broadcaster.broadcast(self._recipients, deliver):
+            if not result.ok:
+                logging.error(f"Ошибка отправки планового отчёта {result.recipient}: {result.error}")
+
+        if kind == "daily":
+            await self._jobs.build(("general", None, None), build_general_report, None, None)
+
+
+report_scheduler = ReportScheduler(
+    report_jobs,
+    ADMIN_CHAT_IDS,
+    [("daily", REPORT_DAILY_AT, False), ("monthly", REPORT_MONTHLY_AT, True)],
+)
 
-        with open(file_name, "rb") as file:
-            await bot.send_document(
-                chat_id=message.chat.id,
-                document=types.BufferedInputFile(file.read(), filename=file_name),
-                caption="📊 Отчет по завершенным заявкам"
-            )
 
-        await message.answer("✅ Отчет успешно сгенерирован и отправлен!")
+async def send_latest_scheduled_reports(message: types.Message):
+    if not report_scheduler.latest:
+        await message.answer("Плановых отчётов пока не было. Используйте /rep [с] [по].")
+        return
+    for file_name, content, caption in report_scheduler.latest.values():
+        await message.answer_document(types.BufferedInputFile(content, filename=file_name), caption=caption)
+
 
+@dp.message(Command("rebuild_rollup"))
+async def cmd_rebuild_rollup(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        rows = await run_report(db_rebuild_rollup)
+        report_cache.clear()
+        await message.answer(f"✅ Сводная таблица отчётов пересчитана: {rows} строк.")
     except Exception as e:
-        logging.error(f"Ошибка генерации отчета: {e}")
-        await message.answer("❌ Ошибка при генерации отчета")
-    finally:
-        if connection:
-            connection.close()
-        if file_name and os.path.exists(file_name):
-            os.remove(file_name)
+        logging.error(f"Ошибка пересчёта report_daily_rollup: {e}")
+        await message.answer("❌ Ошибка пересчёта сводной таблицы")
 
 
 @dp.callback_query(lambda c: c.data == "yes")
@@ -1082,17 +3107,30 @@ async def request_revision(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer("📝 Введите комментарий для доработки:")
 
 
-@dp.message(RevisionStates.revision_comment)
-async def process_revision_comment(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
-    order_id = user_data['order_id']
-    comment = message.text
-    logging.info(f"Expert submitted revision comment for order #{order_id}: {comment}")
-
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-
+def revision_request_outbox(order_id, ph_tg_id, comment):
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(
+        text="Отправить фото доработки",
+        callback_data=f"activate_revision_{order_id}"
+    ))
+    builder.row(InlineKeyboardButton(
+        text="💬 Ответить эксперту",
+        callback_data=f"reply_expert_{order_id}"
+    ))
+    return [outbox_message(
+        ph_tg_id,
+        f"📝 Получен комментарий по заявке #{order_id}:\n\n{comment}\n\n"
+        "Нажмите кнопку ниже, чтобы начать отправку фотографий с исправлениями, "
+        "или ответьте эксперту текстом:",
+        builder.as_markup()
+    )]
+
+
+def db_request_revision(connection, order_id, comment, outbox_key):
+    with connection.cursor() as cursor:
+        connection.begin()
+        if db_lock_order_status(cursor, order_id) == 'Завершено':
+            db_rollup_order(cursor, order_id, -1)
         cursor.execute(
             "UPDATE orders SET status = 'На доработке', revision_comment = %s WHERE id = %s",
             (comment, order_id)
@@ -1112,32 +3150,29 @@ async def process_revision_comment(message: types.Message, state: FSMContext):
         ph_tg_id = cursor.fetchone()[0]
         logging.info(f"Found PH Telegram ID: {ph_tg_id}")
 
-        connection.commit()
-
         cursor.execute(
             "INSERT INTO revision_states (order_id, ph_id, state) VALUES (%s, %s, %s) "
             "ON DUPLICATE KEY UPDATE state = VALUES(state)",
             (order_id, ph_id, "RevisionStates:revision_photos")
         )
+        db_enqueue_outbox(cursor, outbox_key, revision_request_outbox(order_id, ph_tg_id, comment))
         connection.commit()
+    return ph_id, ph_tg_id
 
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(
-            text="Отправить фото доработки",
-            callback_data=f"activate_revision_{order_id}"
-        ))
-        builder.row(InlineKeyboardButton(
-            text="💬 Ответить эксперту",
-            callback_data=f"reply_expert_{order_id}"
-        ))
 
-        await bot.send_message(
-            ph_tg_id,
-            f"📝 Получен комментарий по заявке #{order_id}:\n\n{comment}\n\n"
-            "Нажмите кнопку ниже, чтобы начать отправку фотографий с исправлениями, "
-            "или ответьте эксперту текстом:",
-            reply_markup=builder.as_markup()
+@dp.message(RevisionStates.revision_comment)
+async def process_revision_comment(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
+    order_id = user_data['order_id']
+    comment = message.text
+    logging.info(f"Expert submitted revision comment for order #{order_id}: {comment}")
+
+    try:
+        ph_id, ph_tg_id = await run_db(
+            db_request_revision, order_id, comment, f"revision:{order_id}:{message.message_id}"
         )
+        outbox.wake()
+        invalidate_ph_statistics(ph_id)
 
         await message.answer("✅ Комментарий отправлен исполнителю!")
         logging.info(f"Revision comment sent to PH {ph_tg_id} for order #{order_id}")
@@ -1146,14 +3181,13 @@ async def process_revision_comment(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка при обработке комментария: {e}", exc_info=True)
         await message.answer("❌ Ошибка при отправке комментария")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
 
 @dp.message(RevisionStates.revision_photos, F.photo)
-async def process_revision_photos(message: types.Message, state: FSMContext):
-    logging.info(f"Received photo from PH {message.from_user.id} in revision_photos state")
+async def process_revision_photos(message: types.Message, state: FSMContext, album=None):
+    new_photos = album_file_ids(message, album)
+    logging.info(f"Received {len(new_photos)} photo(s) from PH {message.from_user.id} in revision_photos state")
 
     user_data = await state.get_data()
     photos = user_data.get('photos', [])
@@ -1163,33 +3197,33 @@ async def process_revision_photos(message: types.Message, state: FSMContext):
         await message.answer("⚠️ Максимум 3 фото! Нажмите 'Завершить отправку фото'")
         return
 
-    photos.append(message.photo[-1].file_id)
+    skipped = max(0, len(photos) + len(new_photos) - 3)
+    photos.extend(new_photos[:len(new_photos) - skipped])
     await state.update_data(photos=photos)
-    logging.info(f"Photo added. Total photos: {len(photos)}")
+    logging.info(f"Photos added. Total photos: {len(photos)}")
 
     if len(photos) < 3:
         await message.answer(f"✅ Фото {len(photos)}/3 принято. Отправьте еще или нажмите кнопку завершения.")
     else:
-        await message.answer("✅ Принято 3 фото. Нажмите 'Завершить отправку фото' для отправки.")
+        await message.answer("✅ Принято 3 фото. Нажмите 'Завершить отправку фото' для отправки."
+                             + (f" Лишние фото ({skipped}) не приняты." if skipped else ""))
 
 
-@dp.message(RevisionStates.revision_photos, F.text == "Завершить отправку фото")
-async def finish_revision_photos(message: types.Message, state: FSMContext):
-    logging.info(f"PH {message.from_user.id} finished photo upload for revision")
-
-    user_data = await state.get_data()
-    photos = user_data.get('photos', [])
-    order_id = user_data['order_id']
-    logging.info(f"Processing revision photos for order #{order_id}. Photo count: {len(photos)}")
-
-    if not photos:
-        await message.answer("❌ Нужно отправить хотя бы одно фото!")
-        return
+def revision_result_outbox(order_id, expert_tg_id, photos):
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="✅ Принять", callback_data=f'accept_{order_id}'),
+        InlineKeyboardButton(text="🔄 На доработку", callback_data=f'revision_{order_id}')
+    )
+    return [
+        outbox_media_group(expert_tg_id, photos, f"Результат доработки по заявке #{order_id}"),
+        outbox_message(expert_tg_id, f"Заявка #{order_id} готова к проверке:", builder.as_markup()),
+    ]
 
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
 
+def db_submit_revision(connection, order_id, photos, outbox_key):
+    with connection.cursor() as cursor:
+        connection.begin()
         # Обновляем статус заявки
         cursor.execute(
             "UPDATE orders SET status = 'Ожидает проверки' WHERE id = %s",
@@ -1204,10 +3238,10 @@ async def finish_revision_photos(message: types.Message, state: FSMContext):
 
         # Получаем данные эксперта
         cursor.execute(
-            "SELECT expert_id FROM orders WHERE id = %s",
+            "SELECT expert_id, ph_id FROM orders WHERE id = %s",
             (order_id,)
         )
-        expert_id = cursor.fetchone()[0]
+        expert_id, ph_id = cursor.fetchone()
         logging.info(f"Found expert ID: {expert_id}")
 
         cursor.execute(
@@ -1217,27 +3251,31 @@ async def finish_revision_photos(message: types.Message, state: FSMContext):
         expert_tg_id = cursor.fetchone()[0]
         logging.info(f"Found expert Telegram ID: {expert_tg_id}")
 
+        db_enqueue_outbox(cursor, outbox_key, revision_result_outbox(order_id, expert_tg_id, photos))
         connection.commit()
+    return ph_id, expert_tg_id
 
-        # Отправляем фотографии эксперту
-        media = [types.InputMediaPhoto(media=photo) for photo in photos]
-        if media:
-            media[0].caption = f"Результат доработки по заявке #{order_id}"
-            await bot.send_media_group(chat_id=expert_tg_id, media=media)
-
-            # Создаем клавиатуру для эксперта
-            builder = InlineKeyboardBuilder()
-            builder.row(
-                InlineKeyboardButton(text="✅ Принять", callback_data=f'accept_{order_id}'),
-                InlineKeyboardButton(text="🔄 На доработку", callback_data=f'revision_{order_id}')
-            )
 
-            await bot.send_message(
-                chat_id=expert_tg_id,
-                text=f"Заявка #{order_id} готова к проверке:",
-                reply_markup=builder.as_markup()
-            )
-            logging.info(f"Revision results sent to expert {expert_tg_id}")
+@dp.message(RevisionStates.revision_photos, F.text == "Завершить отправку фото")
+async def finish_revision_photos(message: types.Message, state: FSMContext):
+    logging.info(f"PH {message.from_user.id} finished photo upload for revision")
+
+    user_data = await state.get_data()
+    photos = user_data.get('photos', [])
+    order_id = user_data['order_id']
+    logging.info(f"Processing revision photos for order #{order_id}. Photo count: {len(photos)}")
+
+    if not photos:
+        await message.answer("❌ Нужно отправить хотя бы одно фото!")
+        return
+
+    try:
+        ph_id, expert_tg_id = await run_db(
+            db_submit_revision, order_id, photos, f"revision_done:{order_id}:{message.message_id}"
+        )
+        outbox.wake()
+        invalidate_ph_statistics(ph_id)
+        logging.info(f"Revision results queued for expert {expert_tg_id}")
 
         await message.answer("✅ Результат доработки отправлен эксперту!", reply_markup=ReplyKeyboardRemove())
 
@@ -1245,39 +3283,52 @@ async def finish_revision_photos(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка при завершении доработки: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при отправке")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
         logging.info(f"State cleared for PH {message.from_user.id}")
 
 
-@dp.callback_query(lambda c: c.data.startswith("accept_"))
-async def accept_revision(callback: types.CallbackQuery):
-    order_id = int(callback.data.split('_')[1])
-
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
+def db_accept_order(connection, order_id, outbox_key):
+    """Принимает доработку; None — заявка уже не ждёт проверки."""
+    with connection.cursor() as cursor:
+        connection.begin()
         cursor.execute(
-            "UPDATE orders SET status = 'Завершено' WHERE id = %s",
+            "UPDATE orders SET status = 'Завершено' WHERE id = %s AND status = 'Ожидает проверки'",
             (order_id,)
         )
-        connection.commit()
+        if cursor.rowcount != 1:
+            connection.rollback()
+            return None
+        db_rollup_order(cursor, order_id, 1)
 
         cursor.execute(
-            "SELECT ph.tg_id FROM orders o LEFT JOIN users_ph ph ON ph.id = o.ph_id WHERE o.id = %s",
+            "SELECT o.ph_id, ph.tg_id FROM orders o LEFT JOIN users_ph ph ON ph.id = o.ph_id WHERE o.id = %s",
             (order_id,)
         )
-        ph_tg_id = cursor.fetchone()[0]
-        await bot.send_message(chat_id=ph_tg_id, text=f"✅ Эксперт принял доработку по заявке #{order_id}!")
+        ph_id, ph_tg_id = cursor.fetchone()
+        db_enqueue_outbox(cursor, outbox_key, [
+            outbox_message(ph_tg_id, f"✅ Эксперт принял доработку по заявке #{order_id}!")
+        ])
+        connection.commit()
+    return ph_id, ph_tg_id
+
+
+@dp.callback_query(lambda c: c.data.startswith("accept_"))
+async def accept_revision(callback: types.CallbackQuery):
+    order_id = int(callback.data.split('_')[1])
+
+    try:
+        accepted = await run_db(db_accept_order, order_id, f"accept:{order_id}:{callback.id}")
+        if accepted is None:
+            await callback.answer("⚠️ Заявка уже не ждёт проверки", show_alert=True)
+            return
+        ph_id, ph_tg_id = accepted
+        outbox.wake()
+        invalidate_ph_statistics(ph_id)
         await callback.message.edit_text(f"✅ Заявка #{order_id} принята!")
 
     except Exception as e:
         logging.error(f"Ошибка при принятии заявки: {e}")
         await callback.answer("❌ Ошибка!")
-    finally:
-        cursor.close()
-        connection.close()
 
 
 @dp.callback_query(lambda c: c.data.startswith("revision_"))
@@ -1306,19 +3357,22 @@ async def send_result_to_expert(expert_tg_id, photos, order_id):
         )
 
 
+def db_fetch_revision_state(connection, order_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT state FROM revision_states WHERE order_id = %s",
+            (order_id,)
+        )
+        return cursor.fetchone()
+
+
 @dp.callback_query(lambda c: c.data.startswith("activate_revision_"))
 async def activate_revision_state(callback: types.CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split('_')[-1])
     logging.info(f"Activating revision state for order #{order_id}")
 
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT state FROM revision_states WHERE order_id = %s",
-            (order_id,)
-        )
-        state_data = cursor.fetchone()
+        state_data = await run_db(db_fetch_revision_state, order_id)
 
         if state_data and state_data[0] == "RevisionStates:revision_photos":
             await state.set_state(RevisionStates.revision_photos)
@@ -1342,8 +3396,6 @@ async def activate_revision_state(callback: types.CallbackQuery, state: FSMConte
     except Exception as e:
         logging.error(f"Ошибка активации состояния: {e}")
         await callback.answer("❌ Ошибка активации", show_alert=True)
-    finally:
-        connection.close()
 
 
 @ph_router.callback_query(lambda c: c.data.startswith("reply_expert_"))
@@ -1363,6 +3415,15 @@ async def start_reply_to_expert(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
+def db_fetch_order_expert_tg_id(connection, order_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ue.tg_id FROM orders o JOIN users_expert ue ON ue.id = o.expert_id WHERE o.id = %s",
+            (order_id,),
+        )
+        return cursor.fetchone()
+
+
 @ph_router.message(RevisionReplyStates.text)
 async def send_reply_to_expert(message: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -1374,13 +3435,7 @@ async def send_reply_to_expert(message: types.Message, state: FSMContext):
         return
 
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT ue.tg_id FROM orders o JOIN users_expert ue ON ue.id = o.expert_id WHERE o.id = %s",
-            (order_id,),
-        )
-        row = cursor.fetchone()
+        row = await run_db(db_fetch_order_expert_tg_id, order_id)
         if not row:
             await message.answer("❌ Не нашёл эксперта по заявке")
             await state.clear()
@@ -1397,30 +3452,35 @@ async def send_reply_to_expert(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка отправки ответа эксперту: {e}", exc_info=True)
         await message.answer("⚠️ Не удалось отправить ответ")
     finally:
-        try:
-            cursor.close()
-            connection.close()
-        except Exception:
-            pass
         await state.clear()
 
 
+def db_fetch_order_status(connection, order_id):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
+        return cursor.fetchone()[0]
+
+
+@ph_router.callback_query(lambda c: c.data.startswith("skip_order_"))
+async def skip_order(callback: types.CallbackQuery):
+    order_id = int(callback.data.split("_")[-1])
+    ph_id = await get_ph_id(callback.from_user.id)
+
+    if ph_id and await order_dispatcher.skip(order_id, ph_id):
+        await callback.answer("⏭ Заявка передана другому исполнителю")
+    else:
+        await callback.answer("⚠️ Заявка вам больше не предложена", show_alert=True)
+
+
 @ph_router.callback_query(lambda c: c.data.startswith("retake_order_"))
 async def decline_order_start(callback: types.CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[-1])
 
-    connection = pymysql.connect(**DB_CONFIG)
-    try:
-        cursor = connection.cursor()
-        cursor.execute("SELECT status FROM orders WHERE id = %s", (order_id,))
-        status = cursor.fetchone()[0]
+    status = await run_db(db_fetch_order_status, order_id)
 
-        if status != "Ожидает исполнителя":
-            await callback.answer("⚠️ Заявка уже взята в работу!", show_alert=True)
-            return
-    finally:
-        cursor.close()
-        connection.close()
+    if status != "Ожидает исполнителя":
+        await callback.answer("⚠️ Заявка уже взята в работу!", show_alert=True)
+        return
 
     await state.set_state(DeclineOrderStates.reason)
     await state.update_data(order_id=order_id)
@@ -1432,26 +3492,18 @@ async def decline_order_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@ph_router.message(DeclineOrderStates.reason)
-async def process_decline_reason(message: types.Message, state: FSMContext):
-    reason = message.text
-    user_data = await state.get_data()
-    order_id = user_data['order_id']
-    ph_id = await get_ph_id(message.from_user.id)
-
-    if not ph_id:
-        await message.answer("❌ Ошибка: не найден исполнитель")
-        await state.clear()
-        return
-
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-
+def db_decline_order(connection, order_id, reason, outbox_key):
+    """Отклоняет ждущую исполнителя заявку; None — её уже взяли или отменили."""
+    with connection.cursor() as cursor:
+        connection.begin()
         cursor.execute(
-            "UPDATE orders SET status = 'Отменено', decline_reason = %s WHERE id = %s",
+            "UPDATE orders SET status = 'Отменено', decline_reason = %s "
+            "WHERE id = %s AND status = 'Ожидает исполнителя'",
             (reason, order_id)
         )
+        if cursor.rowcount != 1:
+            connection.rollback()
+            return None
         cursor.execute(
             "SELECT expert_id FROM orders WHERE id = %s",
             (order_id,)
@@ -1464,44 +3516,103 @@ async def process_decline_reason(message: types.Message, state: FSMContext):
         )
         expert_tg_id = cursor.fetchone()[0]
 
-        connection.commit()
-
-        await bot.send_message(
-            expert_tg_id,
-            f"🚫 Ваша заявка #{order_id} отклонена исполнителем\n\n"
-            f"Причина: {reason}"
-        )
-
         cursor.execute(
             "SELECT up.tg_id, om.message_id FROM users_ph up LEFT JOIN order_messages om ON om.ph_id = up.id WHERE om.order_id = %s",
-            (order_id))
+            (order_id,))
         all_messages = cursor.fetchall()
         cursor.execute("SELECT description FROM orders WHERE id = %s", (order_id,))
         description = cursor.fetchone()[0]  # type: ignore
 
-        for target_ph_id, message_id in all_messages:
-            try:
-                new_text = format_order_card(order_id, expert_id, description, "Отклонена исполнителем")
-                await bot.edit_message_text(
-                    chat_id=target_ph_id,
-                    message_id=message_id,
-                    text=new_text,
-                    reply_markup=None
-                )
-            except Exception as e:
-                logging.error(f"Ошибка обновления сообщения {message_id}: {e}")
+        db_enqueue_outbox(cursor, outbox_key, [outbox_message(
+            expert_tg_id,
+            f"🚫 Ваша заявка #{order_id} отклонена исполнителем\n\n"
+            f"Причина: {reason}"
+        )])
+        connection.commit()
+    return expert_id, expert_tg_id, description, all_messages
+
+
+@ph_router.message(DeclineOrderStates.reason)
+async def process_decline_reason(message: types.Message, state: FSMContext):
+    reason = message.text
+    user_data = await state.get_data()
+    order_id = user_data['order_id']
+    ph_id = await get_ph_id(message.from_user.id)
+
+    if not ph_id:
+        await message.answer("❌ Ошибка: не найден исполнитель")
+        await state.clear()
+        return
+
+    try:
+        declined = await run_db(
+            db_decline_order, order_id, reason, f"decline:{order_id}:{message.message_id}"
+        )
+        if declined is None:
+            await message.answer("⚠️ Заявка уже взята в работу!")
+            return
+        expert_id, expert_tg_id, description, all_messages = declined
+        outbox.wake()
+        order_dispatcher.close(order_id)
 
         await message.answer("✅ Заявка успешно отклонена")
 
+        await card_updater.update(
+            all_messages, format_order_card(order_id, expert_id, description, "Отклонена исполнителем")
+        )
+
     except Exception as e:
         logging.error(f"Ошибка при отказе от заявки: {e}")
         await message.answer("❌ Ошибка при обработке отказа")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
 
+def db_fetch_ph_statistics(connection, ph_id):
+    """Вся статистика исполнителя одним запросом с условной агрегацией."""
+    today_start = datetime.combine(date.today(), datetime.min.time())
+    tomorrow_start = today_start + timedelta(days=1)
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+                       SELECT up.order_price,
+                              COALESCE(SUM(CASE WHEN o.status = 'Завершено' THEN o.result_photo END), 0),
+                              COUNT(CASE WHEN o.status = 'На доработке' THEN 1 END),
+                              COUNT(CASE WHEN o.status = 'В работе' THEN 1 END),
+                              COUNT(CASE WHEN o.status = 'Ожидает проверки' THEN 1 END),
+                              COALESCE(SUM(CASE
+                                               WHEN o.status = 'Завершено'
+                                                   AND o.created_at >= %s
+                                                   AND o.created_at < %s
+                                                   THEN o.result_photo END), 0)
+                       FROM users_ph up
+                                LEFT JOIN orders o
+                                          ON o.ph_id = up.id
+                                              AND o.status IN ('Завершено', 'На доработке', 'В работе', 'Ожидает проверки')
+                       WHERE up.id = %s
+                       GROUP BY up.id, up.order_price
+                       """, (today_start, tomorrow_start, ph_id))
+        return cursor.fetchone()
+
+
+ph_stats_cache = TTLCache(PH_STATS_CACHE_SIZE, PH_STATS_CACHE_TTL)
+
+
+async def get_ph_statistics(ph_id):
+    """Статистика из кэша; запись сбрасывается при смене статуса заявок исполнителя и в полночь."""
+    cached = ph_stats_cache.get(ph_id)
+    if cached is not None and cached[0] == date.today():
+        return cached[1]
+    stats = await run_db(db_fetch_ph_statistics, ph_id)
+    if stats:
+        ph_stats_cache.set(ph_id, (date.today(), stats))
+    return stats
+
+
+def invalidate_ph_statistics(ph_id):
+    ph_stats_cache.invalidate(ph_id)
+
+
 @dp.message(F.text == "Моя статистика")
 async def show_ph_statistics(message: types.Message):
     ph_id = await get_ph_id(message.from_user.id)
@@ -1510,66 +3621,12 @@ async def show_ph_statistics(message: types.Message):
         return
 
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-
-        cursor.execute("SELECT order_price FROM users_ph WHERE id = %s", (ph_id,))
-        result = cursor.fetchone()
-        if not result:
+        stats = await get_ph_statistics(ph_id)
+        if not stats:
             await message.answer("❌ Ошибка получения данных исполнителя.")
             return
-        order_price = result[0]
-
-        # Получаем все значения и обрабатываем None
-        cursor.execute("""
-                       SELECT SUM(result_photo)
-                       FROM orders
-                       WHERE ph_id = %s
-                         AND status = 'Завершено'
-                       """, (ph_id,))
-        completed_count_result = cursor.fetchone()
-        completed_count = completed_count_result[0] or 0  # Преобразуем None в 0
-
-        cursor.execute("""
-                       SELECT COUNT(*)
-                       FROM orders
-                       WHERE ph_id = %s
-                         AND status = 'На доработке'
-                       """, (ph_id,))
-        revision_requested_count_result = cursor.fetchone()
-        revision_requested_count = revision_requested_count_result[0] or 0
-
-        cursor.execute("""
-                       SELECT COUNT(*)
-                       FROM orders
-                       WHERE ph_id = %s
-                         AND status = 'В работе'
-                       """, (ph_id,))
-        in_progress_count_result = cursor.fetchone()
-        in_progress_count = in_progress_count_result[0] or 0
-
-        cursor.execute("""
-                       SELECT COUNT(*)
-                       FROM orders
-                       WHERE ph_id = %s
-                         AND status = 'Ожидает проверки'
-                       """, (ph_id,))
-        revision_pending_approval_count_result = cursor.fetchone()
-        revision_pending_approval_count = revision_pending_approval_count_result[0] or 0
-
-        today_start = datetime.combine(date.today(), datetime.min.time())
-        today_end = datetime.combine(date.today(), datetime.max.time())
-
-        cursor.execute("""
-                       SELECT SUM(result_photo)
-                       FROM orders
-                       WHERE ph_id = %s
-                         AND status = 'Завершено'
-                         AND created_at >= %s
-                         AND created_at <= %s
-                       """, (ph_id, today_start, today_end))
-        completed_today_count_result = cursor.fetchone()
-        completed_today_count = completed_today_count_result[0] or 0
+        (order_price, completed_count, revision_requested_count, in_progress_count,
+         revision_pending_approval_count, completed_today_count) = stats
 
         earnings_today = completed_today_count * order_price
 
@@ -1588,14 +3645,15 @@ async def show_ph_statistics(message: types.Message):
     except Exception as e:
         logging.error(f"Ошибка получения статистики исполнителя: {e}")
         await message.answer("❌ Произошла ошибка при получении статистики.")
-    finally:
-        try:
-            if 'cursor' in locals() and cursor:
-                cursor.close()
-            if 'connection' in locals() and connection:
-                connection.close()
-        except Exception:
-            pass
+
+
+def db_delete_revision_state(connection, order_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM revision_states WHERE order_id = %s",
+            (order_id,)
+        )
+        connection.commit()
 
 
 @dp.message(RevisionStates.revision_photos, F.text == "❌ Отменить доработку")
@@ -1606,15 +3664,7 @@ async def cancel_revision(message: types.Message, state: FSMContext):
     logging.info(f"PH {message.from_user.id} cancelled revision for order #{order_id}")
 
     try:
-        connection = pymysql.connect(**DB_CONFIG)
-        cursor = connection.cursor()
-
-        cursor.execute(
-            "DELETE FROM revision_states WHERE order_id = %s",
-            (order_id,)
-        )
-
-        connection.commit()
+        await run_db(db_delete_revision_state, order_id)
 
         await message.answer(
             "❌ Доработка отменена. Вы можете вернуться к ней позже через уведомление от эксперта.",
@@ -1625,17 +3675,43 @@ async def cancel_revision(message: types.Message, state: FSMContext):
         logging.error(f"Ошибка при отмене доработки: {e}")
         await message.answer("❌ Произошла ошибка при отмене доработки")
     finally:
-        cursor.close()
-        connection.close()
         await state.clear()
 
+@dp.message(Command("pools"))
+async def cmd_pools(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    lines = [f"db: {db_pool.stats()}", f"role_cache: {role_cache.stats()}",
+             f"ph_stats_cache: {ph_stats_cache.stats()}", f"report_jobs: {report_jobs.stats()}",
+             f"fsm: {storage.stats()}", f"updates: {chat_serializer.stats()}",
+             f"outbox: {outbox.stats()}", f"send: {send_scheduler.stats()}",
+             f"cards: {card_updater.stats()}", f"dispatch: {order_dispatcher.stats()}"]
+    for executor in (oltp_executor, report_executor):
+        lines.append(f"{executor.name}: {executor.stats()}")
+    await message.answer("\n".join(lines))
+
+
 async def main():
-    ensure_invites_table()
+    await apply_migrations()
     await bot.set_my_commands([
         types.BotCommand(command="menu", description="Показать меню"),
         types.BotCommand(command="start", description="Начало"),
     ])
-    await dp.start_polling(bot)
+    report_scheduler.start()
+    storage.start()
+    outbox.start()
+    await order_dispatcher.restore()
+    order_dispatcher.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        report_scheduler.stop()
+        await outbox.stop()
+        await order_dispatcher.stop()
+        oltp_executor.shutdown()
+        report_executor.shutdown()
+        report_jobs.shutdown()
+        db_pool.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
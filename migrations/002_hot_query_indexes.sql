@@ -0,0 +1,6 @@
+CREATE INDEX idx_users_expert_tg_id ON users_expert (tg_id);
+CREATE INDEX idx_users_ph_tg_id ON users_ph (tg_id);
+CREATE INDEX idx_orders_ph_status ON orders (ph_id, status);
+CREATE INDEX idx_orders_expert_status ON orders (expert_id, status);
+CREATE INDEX idx_orders_status_created ON orders (status, created_at);
+CREATE INDEX idx_order_messages_order ON order_messages (order_id);
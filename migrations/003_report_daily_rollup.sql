@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS report_daily_rollup (
+    day           DATE    NOT NULL,
+    expert_id     INT     NOT NULL,
+    ph_id         INT     NOT NULL,
+    orders_count  INT     NOT NULL DEFAULT 0,
+    photos_sum    INT     NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, expert_id, ph_id)
+);
+INSERT IGNORE INTO report_daily_rollup (day, expert_id, ph_id, orders_count, photos_sum)
+SELECT DATE(created_at), expert_id, ph_id, COUNT(*), COALESCE(SUM(result_photo), 0)
+FROM orders
+WHERE status = 'Завершено'
+GROUP BY DATE(created_at), expert_id, ph_id;
@@ -0,0 +1,2 @@
+ALTER TABLE orders ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);
+CREATE INDEX idx_orders_updated_at ON orders (updated_at);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    storage_key  VARCHAR(255) PRIMARY KEY,
+    state        VARCHAR(255) NULL,
+    data         MEDIUMTEXT   NOT NULL,
+    updated_at   TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)
+);
@@ -0,0 +1 @@
+CREATE INDEX idx_fsm_storage_updated_at ON fsm_storage (updated_at);
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS outbox (
+    id               BIGINT AUTO_INCREMENT PRIMARY KEY,
+    idempotency_key  VARCHAR(191) NOT NULL,
+    chat_id          BIGINT       NOT NULL,
+    method           VARCHAR(32)  NOT NULL,
+    payload          MEDIUMTEXT   NOT NULL,
+    status           VARCHAR(16)  NOT NULL DEFAULT 'pending',
+    attempts         INT          NOT NULL DEFAULT 0,
+    next_attempt_at  TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    last_error       TEXT         NULL,
+    created_at       TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    sent_at          TIMESTAMP(6) NULL,
+    UNIQUE KEY uq_outbox_idempotency_key (idempotency_key),
+    KEY idx_outbox_status_next (status, next_attempt_at),
+    KEY idx_outbox_chat_status (chat_id, status, id)
+);
@@ -0,0 +1,2 @@
+ALTER TABLE orders ADD COLUMN taken_at TIMESTAMP NULL;
+ALTER TABLE orders ADD COLUMN completed_at TIMESTAMP NULL;
@@ -0,0 +1,100 @@
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+os.environ.setdefault("API_TOKEN", "1:abc")
+os.environ.setdefault("FSM_STORAGE", "memory")
+
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.methods import SendMediaGroup, SendMessage, SendPhoto  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, PhotoSize, Update, User  # noqa: E402
+
+import main_bot  # noqa: E402
+
+
+def make_message(message_id, chat_id=42, text=None, photo=None, media_group_id=None):
+    return Message(
+        message_id=message_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type="private"),
+        from_user=User(id=chat_id, is_bot=False, first_name="Test"),
+        text=text,
+        photo=[PhotoSize(file_id=photo, file_unique_id=photo, width=1, height=1)] if photo else None,
+        media_group_id=media_group_id,
+    )
+
+
+def make_update(update_id, text=None, chat_id=42, **fields):
+    return Update(update_id=update_id, message=make_message(update_id, chat_id, text, **fields))
+
+
+def make_callback_update(update_id, data, chat_id=42):
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id),
+        from_user=User(id=chat_id, is_bot=False, first_name="Test"),
+        chat_instance=str(chat_id),
+        data=data,
+        message=make_message(update_id, chat_id),
+    ))
+
+
+def storage_key(chat_id=42):
+    return StorageKey(bot_id=main_bot.bot.id, chat_id=chat_id, user_id=chat_id)
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    # Один цикл на все тесты: примитивы asyncio в main_bot создаются при импорте.
+    loop = asyncio.new_event_loop()
+    yield loop
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+@pytest.fixture
+def run(event_loop):
+    return event_loop.run_until_complete
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Запросы бота к Telegram: перехватываются на уровне сессии, после SendScheduler."""
+    requests = []
+
+    async def fake_make_request(bot, method, timeout=None):
+        requests.append(method)
+        await asyncio.sleep(0.01)  # даём следующим апдейтам встать в очередь чата
+        if isinstance(method, (SendMessage, SendPhoto)):
+            return make_message(len(requests), method.chat_id)
+        if isinstance(method, SendMediaGroup):
+            return [make_message(len(requests), method.chat_id) for _ in method.media]
+        return True
+
+    monkeypatch.setattr(main_bot.bot.session, "make_request", fake_make_request)
+    # Лимит на чат остаётся, но не растягивает тесты на секунды.
+    monkeypatch.setattr(main_bot.send_scheduler, "_per_chat_interval", 0.01)
+    return requests
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Ответы БД для run_db: {db_функция: результат или callable(*args)}."""
+    answers = {}
+
+    async def fake_run_db(func, *args):
+        answer = answers[func]
+        return answer(*args) if callable(answer) else answer
+
+    monkeypatch.setattr(main_bot, "run_db", fake_run_db)
+    return answers
+
+
+async def feed(*updates):
+    """Скармливает апдейты настоящему dp одновременно, как при polling."""
+    return await asyncio.gather(*(main_bot.dp.feed_update(main_bot.bot, update) for update in updates))
@@ -0,0 +1,42 @@
+import pytest
+from aiogram.methods import SendMessage
+
+import main_bot
+from conftest import feed, make_update, storage_key
+
+
+@pytest.fixture(autouse=True)
+def album_latency(monkeypatch):
+    monkeypatch.setattr(main_bot.album_middleware, "_latency", 0.05)
+
+
+def answers(sent):
+    return [method.text for method in sent if isinstance(method, SendMessage)]
+
+
+def test_album_is_one_handler_call(run, sent):
+    key = storage_key(43)
+    run(main_bot.storage.set_state(key, main_bot.CreateOrderStates.photos))
+    run(feed(*(make_update(10 + i, chat_id=43, photo=f"p{i}", media_group_id="g1") for i in range(3))))
+    assert answers(sent) == ["Добавлено фото 3/6. Отправьте ещё или нажмите 'Завершить'"]
+    assert run(main_bot.storage.get_data(key))["photos"] == ["p0", "p1", "p2"]
+
+
+def test_album_right_after_state_change_reaches_photo_handler(run, sent):
+    key = storage_key(44)
+    run(main_bot.storage.set_state(key, main_bot.CreateOrderStates.description))
+    run(feed(
+        make_update(20, "описание", chat_id=44),
+        *(make_update(21 + i, chat_id=44, photo=f"q{i}", media_group_id="g2") for i in range(2)),
+    ))
+    # Альбом пришёл, пока состояние было ещё description, но обрабатывается одним вызовом.
+    assert answers(sent)[1:] == ["Добавлено фото 2/6. Отправьте ещё или нажмите 'Завершить'"]
+    assert run(main_bot.storage.get_data(key))["photos"] == ["q0", "q1"]
+
+
+def test_album_outside_photo_states_is_unpacked(run, sent):
+    key = storage_key(45)
+    run(main_bot.storage.set_state(key, main_bot.LoginStates.login))
+    run(feed(*(make_update(30 + i, chat_id=45, photo=f"r{i}", media_group_id="g3") for i in range(2))))
+    # Каждое фото доходит до хендлера логина отдельно, как без AlbumMiddleware.
+    assert len(answers(sent)) == 2
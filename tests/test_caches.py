@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import time
+
+import main_bot
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = main_bot.TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "a" становится самым свежим
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+
+def test_ttl_cache_expires_and_invalidates():
+    cache = main_bot.TTLCache(maxsize=10, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a", "нет") == "нет"
+    assert cache.stats()["size"] == 0
+
+    cache = main_bot.TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+
+def test_bounded_executor_caps_queue(run):
+    executor = main_bot.BoundedExecutor("test", workers=1, max_queue=1)
+    gate = threading.Event()
+    submitted = []
+
+    def job(n):
+        submitted.append(n)
+        gate.wait(1)
+        return n
+
+    async def scenario():
+        tasks = [asyncio.create_task(executor.run(job, n)) for n in range(3)]
+        await asyncio.sleep(0.05)
+        # Один выполняется, один ждёт в executor-е, третий — на семафоре, а не в очереди потоков.
+        stats = executor.stats()
+        assert (stats["running"], stats["queued"]) == (1, 2)
+        assert executor._executor._work_queue.qsize() == 1
+        gate.set()
+        return await asyncio.gather(*tasks)
+
+    assert run(scenario()) == [0, 1, 2]
+    assert executor.stats()["completed"] == 3
+    executor.shutdown()
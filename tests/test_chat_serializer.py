@@ -0,0 +1,9 @@
+from aiogram.methods import SendMessage
+
+from conftest import feed, make_update
+
+
+def test_quick_messages_from_one_chat_see_previous_state(run, sent):
+    run(feed(make_update(1, "🌛 Войти в систему"), make_update(2, "mylogin")))
+    assert [method.text for method in sent if isinstance(method, SendMessage)] == \
+        ["Введите ваш логин:", "Введите ваш пароль:"]
@@ -0,0 +1,44 @@
+import time
+
+from pymysql.constants import SERVER_STATUS
+
+import main_bot
+
+
+class FakeConnection:
+    def __init__(self, server_status=SERVER_STATUS.SERVER_STATUS_AUTOCOMMIT):
+        self.open = True
+        self.server_status = server_status
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.server_status &= ~SERVER_STATUS.SERVER_STATUS_IN_TRANS
+
+
+def checkout(run, pool, connection):
+    pool._idle.append((connection, time.monotonic()))
+    assert run(pool.acquire()) is connection
+
+
+def test_release_after_read_does_not_roll_back(run):
+    pool = main_bot.DBPool({}, maxsize=1)
+    connection = FakeConnection()
+    checkout(run, pool, connection)
+
+    run(pool.release(connection))
+
+    assert connection.rollbacks == 0
+    assert pool.stats() == {"size": 1, "in_use": 0, "idle": 1}
+
+
+def test_release_rolls_back_unfinished_transaction(run):
+    pool = main_bot.DBPool({}, maxsize=1)
+    connection = FakeConnection()
+    checkout(run, pool, connection)
+    connection.server_status |= SERVER_STATUS.SERVER_STATUS_IN_TRANS  # begin() без commit: хендлер упал
+
+    run(pool.release(connection))
+
+    assert connection.rollbacks == 1
+    checkout(run, pool, connection)  # соединение вернулось в пул чистым
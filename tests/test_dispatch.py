@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+
+import pytest
+from aiogram.methods import EditMessageText
+
+import main_bot
+
+# (ph_id, tg_id, заявок «В работе», незакрытых заявок, среднее время выполнения, с)
+PERFORMERS = [
+    (1, 101, 0, 2, 600),
+    (2, 102, 0, 0, 900),
+    (3, 103, 1, 1, 60),
+    (4, 104, 0, 1, None),
+]
+
+
+@pytest.fixture
+def offers(db, monkeypatch):
+    """Кому и какие заявки предлагались: [(order_id, [ph_id], skip_button)]."""
+    db[main_bot.db_fetch_performer_availability] = PERFORMERS
+    monkeypatch.setattr(main_bot, "card_updater", main_bot.CardUpdater(main_bot.bot, concurrency=5, max_retries=1))
+    offered = []
+
+    async def fake_send_order_to_ph(order_id, expert_id, description, photos, performers, skip_button=False):
+        offered.append((order_id, [ph_id for ph_id, _ in performers], skip_button))
+        return [main_bot.DeliveryResult(performer, True, 1000 + performer[0], None) for performer in performers]
+
+    monkeypatch.setattr(main_bot, "send_order_to_ph", fake_send_order_to_ph)
+    return offered
+
+
+def make_dispatcher(**kwargs):
+    availability = main_bot.PerformerAvailability(refresh_interval=60, with_speed=True)
+    return main_bot.OrderDispatcher(availability, **{"wave_size": 0, "wave_interval": 0, **kwargs})
+
+
+def test_idle_performers_least_loaded_first(run, db):
+    db[main_bot.db_fetch_performer_availability] = PERFORMERS
+    availability = main_bot.PerformerAvailability(refresh_interval=60)
+    run(availability.refresh_if_stale())
+
+    assert availability.idle() == [(2, 102), (4, 104), (1, 101)]
+    availability.mark_busy(2)
+    availability.mark_idle(3)
+    assert [ph_id for ph_id, _ in availability.idle()] == [3, 4, 1]
+
+
+def test_broadcast_goes_out_in_waves_until_taken(run, db, offers):
+    dispatcher = make_dispatcher(wave_size=2)
+    db[main_bot.db_fetch_waiting_order_ids] = {5}
+
+    run(dispatcher.dispatch(5, 9, "описание", []))
+    run(dispatcher._widen())
+    db[main_bot.db_fetch_waiting_order_ids] = set()  # заявку взяли
+    run(dispatcher._widen())
+
+    assert offers == [(5, [2, 4], False), (5, [1], False)]
+    assert dispatcher.stats()["waiting"] == 0
+
+
+def test_released_performer_gets_unseen_orders_but_not_stale_ones(run, offers):
+    dispatcher = make_dispatcher()
+    run(dispatcher.dispatch(5, 9, "свежая", []))
+    run(dispatcher.dispatch(6, 9, "брошенная", []))
+    dispatcher._offers[6].created_at = datetime.now() - timedelta(hours=25)
+    offers.clear()
+
+    run(dispatcher.performer_released(3))
+
+    assert offers == [(5, [3], False)]
+
+
+def test_widen_closes_orders_older_than_max_age(run, db, offers):
+    dispatcher = make_dispatcher(max_age_hours=1)
+    db[main_bot.db_fetch_waiting_order_ids] = {5}
+    run(dispatcher.dispatch(5, 9, "описание", []))
+    dispatcher._offers[5].created_at = datetime.now() - timedelta(hours=2)
+
+    run(dispatcher._widen())
+
+    assert dispatcher.stats()["waiting"] == 0
+
+
+@pytest.mark.parametrize("strategy, first", [("least_loaded", 2), ("round_robin", 1), ("fastest", 1)])
+def test_assign_offers_order_to_one_performer(run, offers, strategy, first):
+    dispatcher = make_dispatcher(mode="assign", strategy=strategy)
+
+    run(dispatcher.dispatch(5, 9, "описание", []))
+
+    assert offers == [(5, [first], True)]
+    assert dispatcher.stats()["offered"] == 1
+
+
+def test_reserved_performer_is_not_offered_another_order(run, offers):
+    dispatcher = make_dispatcher(mode="assign", strategy="least_loaded")
+
+    run(dispatcher.dispatch(5, 9, "первая", []))
+    run(dispatcher.dispatch(6, 9, "вторая", []))
+
+    assert offers == [(5, [2], True), (6, [4], True)]
+
+
+def test_skip_passes_order_on_and_closes_the_card(run, sent, offers):
+    dispatcher = make_dispatcher(mode="assign", strategy="round_robin")
+    run(dispatcher.dispatch(5, 9, "описание", []))
+
+    assert run(dispatcher.skip(5, 1)) is True
+    assert run(dispatcher.skip(5, 1)) is False  # заявка уже у другого
+
+    assert offers == [(5, [1], True), (5, [2], True)]
+    edits = [method for method in sent if isinstance(method, EditMessageText)]
+    assert [(edit.chat_id, edit.message_id) for edit in edits] == [(101, 1001)]
+
+
+def test_assign_falls_back_to_broadcast_when_everyone_has_seen_it(run, offers):
+    dispatcher = make_dispatcher(mode="assign", strategy="least_loaded")
+    run(dispatcher.dispatch(5, 9, "описание", []))
+    for ph_id in (2, 4):
+        run(dispatcher.skip(5, ph_id))
+    # Последний свободный тоже пропускает: остаётся разослать всем сразу.
+    run(dispatcher.skip(5, 1))
+
+    assert offers[-1] == (5, [2, 4, 1], False)
+    assert dispatcher.stats()["fallbacks"] == 1
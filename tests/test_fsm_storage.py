@@ -0,0 +1,86 @@
+import asyncio
+
+import main_bot
+from conftest import storage_key
+
+
+def make_storage(backend, **kwargs):
+    return main_bot.PersistentStorage(backend, flush_interval=0.01, **kwargs)
+
+
+def test_writes_are_flushed_and_survive_restart(run):
+    backend = main_bot.MemoryKV()
+    storage = make_storage(backend)
+
+    async def scenario():
+        await storage.set_state(storage_key(60), main_bot.CreateOrderStates.photos)
+        await storage.set_data(storage_key(60), {"photos": ["a"]})
+        assert backend._data == {}  # запись пока только в кэше
+        await asyncio.sleep(0.05)
+        await storage.close()
+
+        restarted = make_storage(backend)
+        return await restarted.get_state(storage_key(60)), await restarted.get_data(storage_key(60))
+
+    assert run(scenario()) == (main_bot.CreateOrderStates.photos.state, {"photos": ["a"]})
+    assert storage.stats()["flushes"] == 1
+
+
+def test_cache_unloads_saved_entries_over_cache_size(run):
+    backend = main_bot.MemoryKV()
+    storage = make_storage(backend, cache_size=2)
+
+    async def scenario():
+        for chat_id in (61, 62, 63):
+            await storage.set_state(storage_key(chat_id), main_bot.LoginStates.login)
+        await storage.flush()
+        return await storage.get_state(storage_key(61))
+
+    assert run(scenario()) == main_bot.LoginStates.login.state  # перечитано из бэкенда
+    assert storage.stats()["cached"] == 2
+    assert storage.unloaded >= 1
+
+
+def test_sweep_expires_only_expirable_states(run):
+    backend = main_bot.MemoryKV()
+    expired_chats = []
+
+    async def on_expire(chat_ids):
+        expired_chats.extend(chat_ids)
+
+    storage = make_storage(backend, idle_ttl=0.01, on_expire=on_expire,
+                           expirable_states={main_bot.CreateOrderStates.description.state})
+
+    async def scenario():
+        await storage.set_state(storage_key(64), main_bot.CreateOrderStates.description)
+        await storage.set_state(storage_key(65), main_bot.CompleteOrderStates.result_photos)
+        await storage.flush()
+        await asyncio.sleep(0.02)
+        await storage.sweep()
+        await storage.flush()
+        return await storage.get_state(storage_key(64)), await storage.get_state(storage_key(65))
+
+    assert run(scenario()) == (None, main_bot.CompleteOrderStates.result_photos.state)
+    assert expired_chats == [64]
+    assert list(backend._data) == [main_bot.DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+                                   .build(storage_key(65))]
+
+
+def test_sweep_expires_backend_only_entries(run):
+    backend = main_bot.MemoryKV()
+    expired_chats = []
+
+    async def on_expire(chat_ids):
+        expired_chats.extend(chat_ids)
+
+    async def scenario():
+        previous = make_storage(backend)
+        await previous.set_state(storage_key(66), main_bot.LoginStates.password)
+        await previous.close()
+        await asyncio.sleep(0.02)
+        # Новый процесс эту запись ещё не читал: она есть только в бэкенде.
+        await make_storage(backend, idle_ttl=0.01, on_expire=on_expire).sweep()
+
+    run(scenario())
+    assert expired_chats == [66]
+    assert backend._data == {}
@@ -0,0 +1,86 @@
+import pymysql
+import pytest
+
+import main_bot
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self._connection = connection
+        self._result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self._connection.executed.append(sql.strip())
+        error = self._connection.errors.get(sql.strip())
+        if error is not None:
+            raise pymysql.MySQLError(error, f"ошибка {error}")
+        if sql.startswith("SELECT GET_LOCK"):
+            self._result = [(1,)]
+        elif sql.startswith("SELECT version"):
+            self._result = [(version,) for version in self._connection.applied]
+        elif sql.startswith("INSERT INTO schema_migrations"):
+            self._connection.applied.append(args[0])
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+
+class FakeConnection:
+    def __init__(self, applied=(), errors=None):
+        self.applied = list(applied)
+        self.errors = errors or {}
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_load_migrations_orders_files_and_splits_statements(tmp_path):
+    (tmp_path / "002_second.sql").write_text("CREATE INDEX b ON t (b);\n", encoding="utf-8")
+    (tmp_path / "001_first.sql").write_text("CREATE TABLE t (a INT);\nALTER TABLE t ADD b INT;\n\n",
+                                            encoding="utf-8")
+    (tmp_path / "README.txt").write_text("не миграция", encoding="utf-8")
+
+    assert main_bot.load_migrations(str(tmp_path)) == [
+        ("001_first", ["CREATE TABLE t (a INT)", "ALTER TABLE t ADD b INT"]),
+        ("002_second", ["CREATE INDEX b ON t (b)"]),
+    ]
+
+
+def test_repository_migrations_load():
+    versions = [version for version, _ in main_bot.load_migrations()]
+    assert versions == sorted(versions) and versions[0].startswith("001_")
+
+
+def test_applies_only_new_migrations_and_tolerates_existing_indexes():
+    connection = FakeConnection(applied=["001_first"], errors={"CREATE INDEX b ON t (b)": main_bot.ER_DUP_KEYNAME})
+    migrations = [("001_first", ["CREATE TABLE t (a INT)"]),
+                  ("002_second", ["CREATE INDEX b ON t (b)", "ALTER TABLE t ADD c INT"])]
+
+    assert main_bot.db_apply_migrations(connection, migrations) == ["002_second"]
+    assert "CREATE TABLE t (a INT)" not in connection.executed
+    assert "ALTER TABLE t ADD c INT" in connection.executed
+    assert connection.applied == ["001_first", "002_second"]
+    assert connection.executed[-1] == "DO RELEASE_LOCK('phbot_migrations')"
+
+
+def test_other_migration_errors_stop_and_release_the_lock():
+    connection = FakeConnection(errors={"ALTER TABLE t ADD c INT": 1146})
+
+    with pytest.raises(pymysql.MySQLError):
+        main_bot.db_apply_migrations(connection, [("001_first", ["ALTER TABLE t ADD c INT"])])
+    assert connection.applied == []
+    assert connection.executed[-1] == "DO RELEASE_LOCK('phbot_migrations')"
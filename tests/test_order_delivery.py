@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from aiogram.methods import EditMessageText, SendMediaGroup, SendMessage, SendPhoto
+
+import main_bot
+
+
+@pytest.fixture(autouse=True)
+def card_updater(monkeypatch):
+    updater = main_bot.CardUpdater(main_bot.bot, concurrency=5, max_retries=1)
+    monkeypatch.setattr(main_bot, "card_updater", updater)
+    return updater
+
+
+def of_type(sent, method_type):
+    return [method for method in sent if isinstance(method, method_type)]
+
+
+def test_cards_go_out_before_one_album_per_performer(run, sent, db):
+    saved = []
+    db[main_bot.db_insert_order_messages] = lambda order_id, rows: saved.extend(rows) or ("Ожидает исполнителя", None)
+
+    results = run(main_bot.send_order_to_ph(5, 9, "описание", ["a", "b"], [(1, 101), (2, 102)]))
+
+    assert [type(method) for method in sent] == [SendMessage, SendMessage, SendMediaGroup, SendMediaGroup]
+    assert all(result.ok for result in results)
+    assert saved == [(5, 1, results[0].value), (5, 2, results[1].value)]
+    albums = {method.chat_id: method for method in of_type(sent, SendMediaGroup)}
+    assert albums[101].reply_parameters.message_id == results[0].value
+    assert [item.media for item in albums[102].media] == ["a", "b"]
+
+
+def test_single_photo_is_sent_as_photo(run, sent, db):
+    db[main_bot.db_insert_order_messages] = ("Ожидает исполнителя", None)
+
+    run(main_bot.send_order_to_ph(6, 9, "описание", ["a"], [(1, 101)]))
+
+    assert [type(method) for method in sent] == [SendMessage, SendPhoto]
+    assert of_type(sent, SendPhoto)[0].photo == "a"
+
+
+def test_cards_delivered_after_take_are_closed(run, sent, db):
+    db[main_bot.db_insert_order_messages] = ("В работе", "Иван")
+
+    run(main_bot.send_order_to_ph(7, 9, "описание", ["a", "b"], [(1, 101), (2, 102)]))
+
+    edits = of_type(sent, EditMessageText)
+    assert sorted(edit.chat_id for edit in edits) == [101, 102]
+    assert all("Статус: В работе у Иван" in edit.text and edit.reply_markup is None for edit in edits)
+    assert not of_type(sent, SendMediaGroup)
+
+
+def test_card_edits_are_coalesced(run, sent, card_updater):
+    card = [(101, 1)]
+
+    async def scenario():
+        first = asyncio.create_task(card_updater.update(card, "раз"))
+        await asyncio.sleep(0.005)  # первая правка уже отправляется
+        await asyncio.gather(first, card_updater.update(card, "два"), card_updater.update(card, "три"))
+        await card_updater.update(card, "три")
+
+    run(scenario())
+    assert [edit.text for edit in of_type(sent, EditMessageText)] == ["раз", "три"]
+    assert card_updater.stats() == {"sent": 2, "coalesced": 2, "skipped": 1, "in_flight": 0}
@@ -0,0 +1,23 @@
+from datetime import date
+
+import pytest
+
+import main_bot
+
+
+@pytest.mark.parametrize("args, period", [
+    ([], (None, None)),
+    (["2024-05"], (date(2024, 5, 1), date(2024, 5, 31))),
+    (["2024-02"], (date(2024, 2, 1), date(2024, 2, 29))),
+    (["2024-12-03"], (date(2024, 12, 3), date(2024, 12, 3))),
+    (["2024-01", "2024-03"], (date(2024, 1, 1), date(2024, 3, 31))),
+    (["2024-01-15", "2024-02-10"], (date(2024, 1, 15), date(2024, 2, 10))),
+])
+def test_parse_report_period(args, period):
+    assert main_bot.parse_report_period(args) == period
+
+
+@pytest.mark.parametrize("args", [["2024-05", "2024-04"], ["2024-01", "2024-02", "2024-03"], ["май"]])
+def test_parse_report_period_rejects_bad_input(args):
+    with pytest.raises(ValueError):
+        main_bot.parse_report_period(args)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+import main_bot
+
+
+def retry_after(seconds=0):
+    return TelegramRetryAfter(method=SimpleNamespace(), message="Flood control", retry_after=seconds)
+
+
+@pytest.fixture
+def make_scheduler(run):
+    schedulers = []
+
+    def make(**kwargs):
+        schedulers.append(main_bot.SendScheduler(**kwargs))
+        return schedulers[-1]
+
+    yield make
+    for scheduler in schedulers:
+        scheduler._task.cancel()
+        run(asyncio.gather(scheduler._task, return_exceptions=True))
+
+
+def request(scheduler, chat_id, priority, log):
+    async def make_request(bot, method):
+        log.append((method.chat_id, priority, time.monotonic()))
+
+    async def send():
+        token = main_bot.send_priority.set(priority)
+        try:
+            await scheduler(make_request, None, SimpleNamespace(chat_id=chat_id))
+        finally:
+            main_bot.send_priority.reset(token)
+
+    return asyncio.create_task(send())
+
+
+def test_interactive_requests_overtake_broadcast(run, make_scheduler):
+    scheduler = make_scheduler(rate=100, per_chat_interval=0.01, per_chat_burst=1)
+    log = []
+
+    async def scenario():
+        scheduler.pause(0.05)
+        tasks = [request(scheduler, chat_id, "broadcast", log) for chat_id in range(1, 4)]
+        tasks.append(request(scheduler, 99, "interactive", log))
+        await asyncio.gather(*tasks)
+
+    run(scenario())
+    assert [priority for _, priority, _ in log] == ["interactive", "broadcast", "broadcast", "broadcast"]
+    stats = scheduler.stats()
+    assert (stats["broadcast"]["granted"], stats["interactive"]["granted"]) == (3, 1)
+
+
+def test_one_chat_is_limited_by_its_own_bucket(run, make_scheduler):
+    scheduler = make_scheduler(rate=100, per_chat_interval=0.1, per_chat_burst=1)
+    log = []
+
+    async def scenario():
+        await asyncio.gather(*(request(scheduler, 7, "interactive", log) for _ in range(2)),
+                             request(scheduler, 8, "interactive", log))
+
+    run(scenario())
+    times = {}
+    for chat_id, _, at in log:
+        times.setdefault(chat_id, []).append(at)
+    assert times[7][1] - times[7][0] >= 0.08
+    assert times[8][0] - times[7][0] < 0.05  # другой чат не ждёт чужой bucket
+
+
+def test_broadcaster_retries_after_flood_control(run):
+    broadcaster = main_bot.Broadcaster(concurrency=2, max_retries=1, priority="broadcast")
+    attempts = []
+
+    async def flaky():
+        attempts.append(main_bot.send_priority.get())
+        if len(attempts) == 1:
+            raise retry_after()
+        return "ok"
+
+    assert run(broadcaster.call(1, flaky)) == "ok"
+    assert attempts == ["broadcast", "broadcast"]
+    assert main_bot.send_priority.get() == "interactive"
+
+
+def test_broadcast_collects_failures_per_recipient(run):
+    broadcaster = main_bot.Broadcaster(concurrency=2, max_retries=0, priority="broadcast")
+
+    async def flooded():
+        raise retry_after()
+
+    async def deliver(recipient):
+        if recipient == 2:
+            return await broadcaster.call(recipient, flooded)
+        return recipient * 10
+
+    results = run(broadcaster.broadcast([1, 2, 3], deliver))
+    assert [(result.recipient, result.ok, result.value) for result in results] == \
+        [(1, True, 10), (2, False, None), (3, True, 30)]
+    assert isinstance(results[1].error, TelegramRetryAfter)
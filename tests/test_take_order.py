@@ -0,0 +1,49 @@
+import pytest
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage
+
+import main_bot
+from conftest import feed, make_callback_update, storage_key
+
+
+@pytest.fixture(autouse=True)
+def performer(db, monkeypatch):
+    monkeypatch.setattr(main_bot, "card_updater", main_bot.CardUpdater(main_bot.bot, concurrency=5, max_retries=1))
+    db[main_bot.db_fetch_user_role] = main_bot.UserRole(ph_id=3, expert_id=None, banned=0)
+    main_bot.role_cache.clear()
+
+
+def callback_answers(sent):
+    return [method.text for method in sent if isinstance(method, AnswerCallbackQuery)]
+
+
+def test_taken_order_starts_result_upload_and_closes_cards(run, sent, db):
+    calls = []
+    db[main_bot.db_take_order] = lambda order_id, ph_id: calls.append((order_id, ph_id)) or \
+        ("ok", ("описание", 9, "Иван", [(101, 11), (102, 12)]))
+
+    run(feed(make_callback_update(1, "take_order_5", chat_id=50)))
+
+    assert calls == [(5, 3)]
+    assert callback_answers(sent) == ["✅ Заявка взята в работу!"]
+    assert [method.chat_id for method in sent if isinstance(method, SendMessage)] == [50]
+    edits = [method for method in sent if isinstance(method, EditMessageText)]
+    assert sorted(edit.chat_id for edit in edits) == [101, 102]
+    assert all("В работе у Иван" in edit.text for edit in edits)
+    assert run(main_bot.storage.get_state(storage_key(50))) == main_bot.CompleteOrderStates.result_photos.state
+    assert run(main_bot.storage.get_data(storage_key(50)))["order_id"] == 5
+
+
+@pytest.mark.parametrize("result, answer", [
+    ("busy", "У вас уже есть заявка в работе!"),
+    ("taken", "⚠️ Заявка уже взята в работу!"),
+    ("cancelled", "⚠️ Заявка была отменена экспертом!"),
+    ("missing", "⚠️ Заявка не найдена!"),
+])
+def test_order_not_taken(run, sent, db, result, answer):
+    db[main_bot.db_take_order] = (result, None)
+
+    run(feed(make_callback_update(2, "take_order_6", chat_id=51)))
+
+    assert callback_answers(sent) == [answer]
+    assert [type(method) for method in sent] == [AnswerCallbackQuery]
+    assert run(main_bot.storage.get_state(storage_key(51))) is None